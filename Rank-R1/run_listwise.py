@@ -96,7 +96,8 @@ class R1ListwiseLlmRanker(ListwiseLlmRanker):
                  step_size,
                  lora_path=None,
                  scoring='generation',
-                 num_repeat=1, cache_dir=None):
+                 num_repeat=1, cache_dir=None,
+                 method='sliding'):
         self.prompt = prompt
         self.lora_path = lora_path
         self.sampling_params = SamplingParams(temperature=0.0,
@@ -113,14 +114,13 @@ class R1ListwiseLlmRanker(ListwiseLlmRanker):
         self.window_size = window_size
         self.step_size = step_size
         self.num_repeat = num_repeat
+        self.method = method
 
         self.total_compare = 0
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
 
-    def compare(self, query: str, docs: List):
-        self.total_compare += 1
-
+    def _build_input(self, query: str, docs: List):
         passages = [doc.text for doc in docs]
 
         passages = "\n".join([f'{self.CHARACTERS[i]} {passages[i]}' for i in range(len(passages))])
@@ -128,12 +128,20 @@ class R1ListwiseLlmRanker(ListwiseLlmRanker):
         user_message = self.prompt['prompt_user'].format(query=query,
                                                          num=len(docs),
                                                          docs=passages)
-        input_text = [
+        return [
             {'role': "system", 'content': system_message},
             {'role': "user", 'content': user_message}
         ]
 
-        outputs = self.llm.chat(input_text,
+    def compare(self, query: str, docs: List):
+        return self.batch_compare([(query, docs)])[0]
+
+    def batch_compare(self, requests: List[Tuple[str, List]]) -> List[str]:
+        # All windows are submitted in a single chat call so that vLLM can batch them.
+        self.total_compare += len(requests)
+        input_texts = [self._build_input(query, docs) for query, docs in requests]
+
+        outputs = self.llm.chat(input_texts,
                                 sampling_params=self.sampling_params,
                                 use_tqdm=False,
                                 lora_request=LoRARequest("R1adapter",
@@ -141,19 +149,22 @@ class R1ListwiseLlmRanker(ListwiseLlmRanker):
                                                          self.lora_path)
                                 if self.lora_path is not None else None,
                                 )
-        self.total_completion_tokens += len(outputs[0].outputs[0].token_ids)
-        self.total_prompt_tokens += len(outputs[0].prompt_token_ids)
-        completion = outputs[0].outputs[0].text
-
         pattern = rf'{self.prompt["pattern"]}'
-        match = re.search(pattern, completion.lower(), re.DOTALL)
-        if match:
-            result = match.group(1).strip()
-        else:
-            result = 'None'
-            print('Input for no match:', input_text)
-            print('Completion for no match:', completion)
-        return result
+        results = []
+        for input_text, output in zip(input_texts, outputs):
+            self.total_completion_tokens += len(output.outputs[0].token_ids)
+            self.total_prompt_tokens += len(output.prompt_token_ids)
+            completion = output.outputs[0].text
+
+            match = re.search(pattern, completion.lower(), re.DOTALL)
+            if match:
+                result = match.group(1).strip()
+            else:
+                result = 'None'
+                print('Input for no match:', input_text)
+                print('Completion for no match:', completion)
+            results.append(result)
+        return results
 
 
 def main(args):
@@ -175,7 +186,8 @@ def main(args):
                                  step_size=args.listwise.step_size,
                                  num_repeat=args.listwise.num_repeat,
                                  prompt=prompt,
-                                 cache_dir=args.run.cache_dir)
+                                 cache_dir=args.run.cache_dir,
+                                 method=args.listwise.method)
 
     query_map = {}
     if args.run.query_file is not None:
@@ -211,8 +223,8 @@ def main(args):
         for qid, _, _ in reranked_rankings:
             ranked_qids.add(qid)
 
-    tic = time.time()
-    for qid, query, ranking in tqdm(first_stage_rankings):
+    rankings_to_do = []
+    for qid, query, ranking in first_stage_rankings:
         if qid in ranked_qids:
             continue
         if args.run.shuffle_ranking is not None:
@@ -222,15 +234,36 @@ def main(args):
                 ranking = ranking[::-1]
             else:
                 raise ValueError(f'Invalid shuffle ranking method: {args.run.shuffle_ranking}.')
+        rankings_to_do.append((qid, query, ranking))
+
+    total_ranked = 0
+    total_comparisons = 0
+    total_prompt_tokens = 0
+    total_completion_tokens = 0
+    tic = time.time()
+    # Queries are reranked --query_batch_size at a time: the n-th window of every query goes to vLLM in one call.
+    for start in tqdm(range(0, len(rankings_to_do), args.run.query_batch_size)):
+        batch = rankings_to_do[start:start + args.run.query_batch_size]
+        reranked = ranker.batch_rerank([(query, ranking) for _, query, ranking in batch])
+
+        total_comparisons += ranker.total_compare
+        total_prompt_tokens += ranker.total_prompt_tokens
+        total_completion_tokens += ranker.total_completion_tokens
+        total_ranked += len(batch)
 
-        reranked = ranker.rerank(query, ranking)
-        write_run_file(args.run.save_path, [(qid, query, reranked)], 'LLMRankers')
+        write_run_file(args.run.save_path, [(qid, query, results) for (qid, query, _), results in zip(batch, reranked)],
+                       'LLMRankers')
 
         # if args.run.log_file is not None:
         #     write_log_file(args.run.log_file, qid, query, completions)
 
     toc = time.time()
 
+    if total_ranked > 0:
+        print(f'Avg comparisons: {total_comparisons/total_ranked}')
+        print(f'Avg prompt tokens: {total_prompt_tokens/total_ranked}')
+        print(f'Avg completion tokens: {total_completion_tokens/total_ranked}')
+        print(f'Avg time per query: {(toc-tic)/total_ranked}')
 
 
 if __name__ == '__main__':
@@ -258,10 +291,14 @@ if __name__ == '__main__':
     run_parser.add_argument('--log_file', type=str, default=None)
     run_parser.add_argument('--scoring', type=str, default='generation', choices=['generation', 'likelihood'])
     run_parser.add_argument('--shuffle_ranking', type=str, default=None, choices=['inverse', 'random'])
+    run_parser.add_argument('--query_batch_size', type=int, default=1,
+                            help='Number of queries whose windows are sent to vLLM together.')
     listwise_parser = commands.add_parser('listwise')
     listwise_parser.add_argument('--window_size', type=int, default=3)
     listwise_parser.add_argument('--step_size', type=int, default=1)
     listwise_parser.add_argument('--num_repeat', type=int, default=1)
+    listwise_parser.add_argument('--method', type=str, default='sliding',
+                                 choices=['sliding', 'tournament'])
 
     args = parse_args(parser, commands)
     main(args)
@@ -1,6 +1,6 @@
 from pyserini.search.lucene import LuceneSearcher
 from pyserini.search._base import get_topics
-from llmrankers.setwise import SetwiseLlmRanker
+from llmrankers.setwise import RankR1SetwiseLlmRanker
 from llmrankers.rankers import SearchResult
 from tqdm import tqdm
 import argparse
@@ -87,12 +87,23 @@ def write_run_file(path, results, tag):
                 rank += 1
 
 
+def print_completion_histogram(completion_lengths, num_forced_answers, num_bins=10):
+    lengths = np.array(completion_lengths)
+    print(f'Completion tokens per generation: '
+          f'p50 {np.percentile(lengths, 50):.0f}, p90 {np.percentile(lengths, 90):.0f}, '
+          f'p99 {np.percentile(lengths, 99):.0f}, max {lengths.max()}')
+    print(f'Forced answers (thinking budget exhausted): {num_forced_answers}/{len(lengths)}')
+    counts, edges = np.histogram(lengths, bins=num_bins)
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print(f'  [{low:7.0f}, {high:7.0f}) {count:8d} {"#" * int(50 * count / counts.max())}')
+
+
 def split_into_shards(data, num_shards):
     k, m = divmod(len(data), num_shards)
     return [data[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(num_shards)]
 
 
-class R1SetwiseLlmRanker(SetwiseLlmRanker):
+class R1SetwiseLlmRanker(RankR1SetwiseLlmRanker):
     CHARACTERS = [f'[{i+1}]' for i in range(20)]
 
     def __init__(self,
@@ -106,15 +117,20 @@ class R1SetwiseLlmRanker(SetwiseLlmRanker):
                  method="heapsort",
                  num_permutation=1,
                  cache_dir=None,
-                 tensor_parallel_size=1):
+                 tensor_parallel_size=1,
+                 verbose=False,
+                 max_tokens=8000,
+                 thinking_budget=None,
+                 answer_max_tokens=32,
+                 stop_at_answer=True):
 
         self.prompt = prompt
+        self.verbose = verbose
         self.lora_path = lora_path
         self.num_child = num_child
         self.num_permutation = num_permutation
         self.k = k
-        self.sampling_params = SamplingParams(temperature=0.0,
-                                              max_tokens=8000)
+        self._init_sampling_params(max_tokens, thinking_budget, answer_max_tokens, stop_at_answer)
         if tokenizer_name_or_path is None:
             tokenizer_name_or_path = model_name_or_path
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path, cache_dir=cache_dir)
@@ -130,96 +146,12 @@ class R1SetwiseLlmRanker(SetwiseLlmRanker):
         self.total_compare = 0
         self.total_completion_tokens = 0
         self.total_prompt_tokens = 0
+        self.completion_lengths = []
+        self.num_forced_answers = 0
 
-    def compare(self, query: str, docs: List):
-        self.total_compare += 1 if self.num_permutation == 1 else self.num_permutation
-
-        id_passage = [(i, p) for i, p in enumerate(docs)]
-        labels = [self.CHARACTERS[i] for i in range(len(docs))]
-        batch_data = []
-        for _ in range(self.num_permutation):
-            batch_data.append([random.sample(id_passage, len(id_passage)),
-                               labels])
-
-        batch_ref = []
-        input_text = []
-        for batch in batch_data:
-            ref = []
-            passages = []
-            characters = []
-            for p, c in zip(batch[0], batch[1]):
-                ref.append(p[0])
-                passages.append(p[1].text)
-                characters.append(c)
-            batch_ref.append((ref, characters))
-            # passages = "\n".join([f'{characters[i]} {passages[i]}' for i in range(len(passages))])
-            
-            passages = [f"{self.prompt['doc_prefix'].format(num=i + 1)}{doc}" for i, doc in enumerate(passages)]
-            passages_text = self.prompt['doc_separator'].join(passages)
-
-            system_message = self.prompt["prompt_system"]
-            user_message = self.prompt['prompt_user'].format(query=query,
-                                                             docs=passages_text)
-            input_text.append([
-                {'role': "system", 'content': system_message},
-                {'role': "user", 'content': user_message}
-            ])
-        outputs = self.llm.chat(input_text,
-                                sampling_params=self.sampling_params,
-                                use_tqdm=False,
-                                lora_request=LoRARequest("R1adapter",
-                                                         1,
-                                                         self.lora_path)
-                                if self.lora_path is not None else None,
-                                )
-        print('------------------------------')
-        print(input_text[0])
-        print(outputs[0].outputs[0].text)
-        print('------------------------------')
-        results = []
-        for output, input in zip(outputs, input_text):
-            self.total_completion_tokens += len(output.outputs[0].token_ids)
-            self.total_prompt_tokens += len(output.prompt_token_ids)
-
-            completion = output.outputs[0].text
-            pattern = rf'{self.prompt["pattern"]}'
-            match = re.search(pattern, completion.lower(), re.DOTALL)
-            if match:
-                results.append(match.group(1).strip())
-            else:
-                results.append(f'input_text:\n{input}, completion:\n{completion}')
-
-        # vote
-        candidates = []
-        for ref, result in zip(batch_ref, results):
-            result = result.strip()
-            docids, characters = ref
-            if result not in characters:
-                print(f"Unexpected output: {result}")
-                continue
-            win_doc = docids[characters.index(result)]
-            candidates.append(win_doc)
-
-        if len(candidates) == 0:
-            print(f"Unexpected voting: {results}")
-            output = "Unexpected voting."
-        else:
-            # handle tie
-            candidate_counts = Counter(candidates)
-            max_count = max(candidate_counts.values())
-            most_common_candidates = [candidate for candidate, count in candidate_counts.items() if
-                                      count == max_count]
-            if len(most_common_candidates) == 1:
-                output = self.CHARACTERS[most_common_candidates[0]]
-            else:
-                output = self.CHARACTERS[random.choice(most_common_candidates)]
-
-        if output in self.CHARACTERS:
-            pass
-        else:
-            print(f"Unexpected output: {output}")
-
-        return output
+    def _format_passages(self, characters, passages):
+        passages = [f"{self.prompt['doc_prefix'].format(num=i + 1)}{doc}" for i, doc in enumerate(passages)]
+        return self.prompt['doc_separator'].join(passages)
 
 
 def main(args):
@@ -241,7 +173,11 @@ def main(args):
                                 method=args.setwise.method,
                                 k=args.setwise.k,
                                 prompt=prompt,
-                                tensor_parallel_size= args.run.tensor_parallel_size)
+                                tensor_parallel_size= args.run.tensor_parallel_size,
+                                max_tokens=args.run.max_tokens,
+                                thinking_budget=args.run.thinking_budget,
+                                answer_max_tokens=args.run.answer_max_tokens,
+                                stop_at_answer=not args.run.disable_early_stop)
 
     query_map = {}
     if args.run.query_file is not None:
@@ -292,12 +228,8 @@ def main(args):
 
         
 
-    total_ranked = 0
-    total_comparisons = 0
-    total_prompt_tokens = 0
-    total_completion_tokens = 0
-    tic = time.time()
-    for qid, query, ranking in tqdm(first_stage_rankings):
+    rankings_to_do = []
+    for qid, query, ranking in first_stage_rankings:
         if qid in ranked_qids:
             continue
         if args.run.shuffle_ranking is not None:
@@ -307,15 +239,29 @@ def main(args):
                 ranking = ranking[::-1]
             else:
                 raise ValueError(f'Invalid shuffle ranking method: {args.run.shuffle_ranking}.')
+        rankings_to_do.append((qid, query, ranking))
+
+    total_ranked = 0
+    total_comparisons = 0
+    total_prompt_tokens = 0
+    total_completion_tokens = 0
+    total_forced_answers = 0
+    completion_lengths = []
+    tic = time.time()
+    # Queries are reranked --query_batch_size at a time so that vLLM sees the comparisons of all of them together.
+    for start in tqdm(range(0, len(rankings_to_do), args.run.query_batch_size)):
+        batch = rankings_to_do[start:start + args.run.query_batch_size]
+        reranked = ranker.batch_rerank([(query, ranking) for _, query, ranking in batch])
 
         total_comparisons += ranker.total_compare
         total_prompt_tokens += ranker.total_prompt_tokens
         total_completion_tokens += ranker.total_completion_tokens
-        total_ranked += 1
-
-        reranked = ranker.rerank(query, ranking)
-        write_run_file(args.run.save_path, [(qid, query, reranked)], 'LLMRankers')
+        total_forced_answers += ranker.num_forced_answers
+        completion_lengths.extend(ranker.completion_lengths)
+        total_ranked += len(batch)
 
+        write_run_file(args.run.save_path, [(qid, query, results) for (qid, query, _), results in zip(batch, reranked)],
+                       'LLMRankers')
 
         # if args.run.log_file is not None:
         #     write_log_file(args.run.log_file, qid, query, completions)
@@ -326,6 +272,8 @@ def main(args):
     print(f'Avg prompt tokens: {total_prompt_tokens/total_ranked}')
     print(f'Avg completion tokens: {total_completion_tokens/total_ranked}')
     print(f'Avg time per query: {(toc-tic)/total_ranked}')
+    if len(completion_lengths) > 0:
+        print_completion_histogram(completion_lengths, total_forced_answers)
 
 
 if __name__ == '__main__':
@@ -358,6 +306,17 @@ if __name__ == '__main__':
     run_parser.add_argument('--dataset_shard_index', type=int, default=0)
     run_parser.add_argument('--tensor_parallel_size', type=int, default=1,
                             help='Tensor parallel size for LLM. Default is 1 for single GPU.')
+    run_parser.add_argument('--max_tokens', type=int, default=8000,
+                            help='Maximum number of tokens generated per comparison.')
+    run_parser.add_argument('--thinking_budget', type=int, default=None,
+                            help='Cut the reasoning after this many tokens (at most --max_tokens) and force the model '
+                                 'to answer.')
+    run_parser.add_argument('--answer_max_tokens', type=int, default=32,
+                            help='Maximum number of tokens for a forced answer.')
+    run_parser.add_argument('--disable_early_stop', action='store_true',
+                            help='Do not stop generation when the answer block is closed.')
+    run_parser.add_argument('--query_batch_size', type=int, default=1,
+                            help='Number of queries whose comparisons are batched together in each vLLM call.')
     
     setwise_parser = commands.add_parser('setwise')
     setwise_parser.add_argument('--num_child', type=int, default=3)
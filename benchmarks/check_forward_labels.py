@@ -0,0 +1,94 @@
+"""
+Checks that --forward_labels answers the same as greedy decoding restricted to the valid labels
+(--constrained_decoding) on padded batches: passages of different lengths go through pairwise compare,
+batch_compare and allpair, and through setwise compare_batch, once with each decoding. Prints the number of
+mismatching answers per call and exits with an error if there is any.
+
+Run from the repository root:
+    python benchmarks/check_forward_labels.py --model_name_or_path google/flan-t5-large --device cpu
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import random
+from itertools import combinations
+from llmrankers.rankers import SearchResult
+from llmrankers.setwise import SetwiseLlmRanker
+from llmrankers.pairwise import PairwiseLlmRanker
+
+WORDS = ['the', 'of', 'river', 'model', 'system', 'data', 'city', 'energy', 'history', 'market', 'protein', 'law',
+         'music', 'school', 'water', 'health', 'game', 'light', 'network', 'policy', 'species', 'court', 'price']
+QUERIES = ['how do rivers form', 'what is protein folding', 'history of the city market']
+
+
+def passages(num, seed):
+    # very different lengths, so that every batch is padded
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 60))) for _ in range(num)]
+
+
+def flatten(outputs):
+    return [answer for output in outputs for answer in (output if isinstance(output, list) else [output])]
+
+
+def mismatches(ranker, call):
+    # the same call with forward_labels and with constrained generate
+    ranker.forward_labels, ranker.constrained = False, True
+    expected = flatten(call())
+    ranker.forward_labels, ranker.constrained = True, False
+    actual = flatten(call())
+    return sum(a != e for a, e in zip(actual, expected)), len(expected)
+
+
+def pairwise_calls(ranker, texts):
+    requests = [(query, [a, b]) for query in QUERIES for a, b in combinations(texts, 2)]
+    allpairs = [ranker.prompt.format(query=query, doc1=a, doc2=b) for query, (a, b) in requests]
+    return {'pairwise.compare': lambda: [ranker.compare(query, docs) for query, docs in requests],
+            'pairwise.batch_compare': lambda: ranker.batch_compare(requests),
+            'pairwise.allpair': lambda: ranker._allpair_outputs(allpairs)}
+
+
+def setwise_calls(ranker, texts, num_child):
+    docs = [SearchResult(docid=str(i), score=0, text=text) for i, text in enumerate(texts)]
+    requests = [(docs[start: start + num_child + 1], ('none', 'back', 'none'))
+                for start in range(0, len(docs) - 1, num_child)]
+    return {'setwise.compare_batch': lambda: [output for query in QUERIES
+                                              for output in ranker.compare_batch(query, requests)]}
+
+
+def check(calls):
+    failed = False
+    for name, call in calls.items():
+        wrong, total = mismatches(*call)
+        print(f'{name}: {wrong}/{total} mismatches')
+        failed = failed or wrong > 0
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name_or_path', type=str, default='google/flan-t5-large')
+    parser.add_argument('--tokenizer_name_or_path', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--cache_dir', type=str, default=None)
+    parser.add_argument('--num_passages', type=int, default=6)
+    parser.add_argument('--num_child', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=929)
+    args = parser.parse_args()
+
+    texts = passages(args.num_passages, args.seed)
+    # batch_size 2: pairwise compare decodes the two orders of a pair with batch_size decoder rows
+    pairwise = PairwiseLlmRanker(args.model_name_or_path, args.tokenizer_name_or_path, args.device,
+                                 method='allpair', batch_size=2, cache_dir=args.cache_dir)
+    setwise = SetwiseLlmRanker(args.model_name_or_path, args.tokenizer_name_or_path, args.device,
+                               num_child=args.num_child, cache_dir=args.cache_dir)
+    calls = {name: (pairwise, call) for name, call in pairwise_calls(pairwise, texts).items()}
+    calls.update({name: (setwise, call) for name, call in setwise_calls(setwise, texts, args.num_child).items()})
+    if not check(calls):
+        sys.exit('--forward_labels does not match constrained generate.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+CPU benchmark of the ranking algorithms. Every method runs on the deterministic StubBackend, whose relevance
+judgements come from graded relevance labels (synthetic, or read from a TREC qrels file) plus seeded noise, so the
+numbers measure the algorithms and not a model: comparisons (model calls), prompt / completion tokens (whitespace
+words), wall time per query and nDCG@10 for every method, hits and num_child setting.
+
+Run from the repository root:
+    python benchmarks/run_benchmarks.py --hits 20 50 100 1000 --num_child 2 3 5 10 --save_path benchmarks.tsv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import copy
+import random
+import time
+from collections import defaultdict
+from llmrankers.rankers import SearchResult
+from llmrankers.backends import StubBackend
+from llmrankers.setwise import BackendSetwiseLlmRanker
+from llmrankers.pairwise import BackendPairwiseLlmRanker
+from llmrankers.listwise import BackendListwiseLlmRanker
+from llmrankers.pointwise import BackendPointwiseLlmRanker
+from llmrankers.metrics import ndcg
+from llmrankers.budget import BudgetController
+
+METHODS = ['setwise.heapsort', 'setwise.bubblesort', 'pairwise.heapsort', 'pairwise.bubblesort', 'pairwise.allpair',
+           'pairwise.bradley_terry', 'listwise.sliding', 'listwise.tournament', 'pointwise.yes_no']
+WORDS = ['the', 'of', 'river', 'model', 'system', 'data', 'city', 'energy', 'history', 'market', 'protein', 'law',
+         'music', 'school', 'water', 'health', 'game', 'light', 'network', 'policy', 'species', 'court', 'price']
+
+
+def passage_text(qid, docid, rng, length):
+    # Unique per (query, doc) so that the stub can map it back to its relevance label.
+    return f'q{qid} d{docid} ' + ' '.join(rng.choice(WORDS) for _ in range(length - 2))
+
+
+def synthetic_rankings(num_queries, hits, passage_length, seed):
+    # First-stage rankings where the chance that a doc is relevant decays with its rank; relevant docs get a
+    # grade in 1..3. Returns [(qid, query, ranking)] and {qid: {docid: grade}}.
+    rng = random.Random(f'{seed}:{hits}')
+    rankings, qrels = [], {}
+    for q in range(num_queries):
+        qid = str(q)
+        qrels[qid] = {}
+        ranking = []
+        for rank in range(hits):
+            docid = f'{qid}-{rank}'
+            if rng.random() < 0.5 / (1 + rank / 10):
+                qrels[qid][docid] = rng.randint(1, 3)
+            ranking.append(SearchResult(docid=docid, score=-rank, text=passage_text(qid, docid, rng, passage_length)))
+        rankings.append((qid, f'query {qid}', ranking))
+    return rankings, qrels
+
+
+def trec_rankings(run_path, qrels_path, num_queries, hits, passage_length, seed):
+    # Rankings of a TREC run file judged with a TREC qrels file; passage texts are placeholders.
+    rng = random.Random(seed)
+    qrels = defaultdict(dict)
+    with open(qrels_path, 'r') as f:
+        for line in f:
+            qid, _, docid, rel = line.strip().split()
+            qrels[qid][docid] = int(rel)
+    runs = defaultdict(list)
+    with open(run_path, 'r') as f:
+        for line in f:
+            qid, _, docid, _, score, _ = line.strip().split()
+            if len(runs[qid]) < hits:
+                runs[qid].append(SearchResult(docid=docid, score=float(score),
+                                              text=passage_text(qid, docid, rng, passage_length)))
+    rankings = [(qid, f'query {qid}', ranking) for qid, ranking in runs.items() if qid in qrels][:num_queries]
+    return rankings, qrels
+
+
+def build_rankers(method, backend, args):
+    # Yields (num_child, ranker); num_child is only varied for setwise.
+    family, name = method.split('.')
+    if family == 'setwise':
+        for num_child in args.num_child:
+            yield num_child, BackendSetwiseLlmRanker(backend, num_child=num_child, k=args.k, scoring=args.scoring,
+                                                     method=name, prior_heap=args.prior_heap,
+                                                     prior_skip_margin=args.prior_skip_margin)
+    elif family == 'pairwise':
+        yield '-', BackendPairwiseLlmRanker(backend, method=name,
+                                            batch_size=args.batch_size if name in ['allpair', 'bradley_terry'] else 2,
+                                            k=args.k, speculative=args.speculative)
+    elif family == 'listwise':
+        yield '-', BackendListwiseLlmRanker(backend, window_size=args.window_size, step_size=args.step_size,
+                                            scoring=args.scoring,
+                                            num_repeat=args.num_repeat if name == 'sliding' else 1, method=name)
+    elif family == 'pointwise':
+        yield '-', BackendPointwiseLlmRanker(backend, method=name, batch_size=args.batch_size)
+    else:
+        raise ValueError(f'Invalid method: {method}.')
+
+
+def main(args):
+    rows = []
+    for hits in args.hits:
+        if args.qrels is not None:
+            rankings, qrels = trec_rankings(args.run_path, args.qrels, args.num_queries, hits, args.passage_length,
+                                            args.seed)
+        else:
+            rankings, qrels = synthetic_rankings(args.num_queries, hits, args.passage_length, args.seed)
+        grades = {doc.text: qrels[qid].get(doc.docid, 0) for qid, _, ranking in rankings for doc in ranking}
+        backend = StubBackend(relevance_fn=lambda text: grades.get(text, 0), noise=args.noise, seed=args.seed,
+                              latency=args.latency, token_latency=args.token_latency)
+
+        first_stage = sum(ndcg(ranking, qrels[qid]) for qid, _, ranking in rankings) / len(rankings)
+        rows.append(['bm25.first_stage', hits, '-', 0.0, 0.0, 0.0, 0.0, first_stage])
+        for method in args.methods:
+            if method == 'pairwise.allpair' and hits > args.max_allpair_hits:
+                print(f'Skipping {method} for hits={hits} (> --max_allpair_hits).')
+                continue
+            for num_child, ranker in build_rankers(method, backend, args):
+                budget = None
+                if args.max_compare is not None or args.max_tokens is not None:
+                    budget = BudgetController(max_compare=args.max_compare, max_tokens=args.max_tokens)
+                comparisons = prompt_tokens = completion_tokens = ndcg_sum = 0
+                tic = time.time()
+                for qid, query, ranking in rankings:
+                    if budget is not None:
+                        reranked = budget.rerank(ranker, query, [copy.copy(doc) for doc in ranking])
+                    else:
+                        reranked = ranker.rerank(query, [copy.copy(doc) for doc in ranking])
+                    comparisons += ranker.total_compare
+                    prompt_tokens += ranker.total_prompt_tokens
+                    completion_tokens += ranker.total_completion_tokens
+                    ndcg_sum += ndcg(reranked, qrels[qid])
+                toc = time.time()
+                num = len(rankings)
+                rows.append([method, hits, num_child, comparisons / num, prompt_tokens / num, completion_tokens / num,
+                             (toc - tic) / num, ndcg_sum / num])
+                print('\t'.join(str(value) for value in rows[-1]))
+
+    header = ['method', 'hits', 'num_child', 'avg_comparisons', 'avg_prompt_tokens', 'avg_completion_tokens',
+              'avg_time_per_query', 'ndcg@10']
+    lines = ['\t'.join(header)]
+    for row in rows:
+        lines.append('\t'.join(f'{value:.4f}' if isinstance(value, float) else str(value) for value in row))
+    print('\n'.join(lines))
+    if args.save_path is not None:
+        with open(args.save_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--methods', type=str, nargs='+', default=METHODS, choices=METHODS)
+    parser.add_argument('--hits', type=int, nargs='+', default=[20, 50, 100, 1000])
+    parser.add_argument('--num_child', type=int, nargs='+', default=[2, 3, 5, 10])
+    parser.add_argument('--num_queries', type=int, default=20)
+    parser.add_argument('--passage_length', type=int, default=100, help='Words per synthetic passage.')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--scoring', type=str, default='generation', choices=['generation', 'likelihood'])
+    parser.add_argument('--prior_heap', action='store_true', help='Setwise: seed the heap with the first-stage order.')
+    parser.add_argument('--prior_skip_margin', type=float, default=None,
+                        help='Setwise: skip comparisons the first-stage scores decide with this margin (in stds).')
+    parser.add_argument('--speculative', action='store_true',
+                        help='Pairwise heapsort: compare both children with the parent in one batch.')
+    parser.add_argument('--window_size', type=int, default=20)
+    parser.add_argument('--step_size', type=int, default=10)
+    parser.add_argument('--num_repeat', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='Batch size of pointwise, pairwise allpair and pairwise bradley_terry.')
+    parser.add_argument('--max_allpair_hits', type=int, default=100,
+                        help='Skip allpair above this many hits (it makes hits * (hits - 1) calls).')
+    parser.add_argument('--noise', type=float, default=0.5,
+                        help='Std of the gaussian noise added to the relevance grade for every judgement.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds slept per backend call.')
+    parser.add_argument('--token_latency', type=float, default=0.0, help='Seconds slept per prompt token.')
+    parser.add_argument('--max_compare', type=int, default=None, help='Per-query budget of model calls.')
+    parser.add_argument('--max_tokens', type=int, default=None, help='Per-query budget of prompt + completion tokens.')
+    parser.add_argument('--seed', type=int, default=929)
+    parser.add_argument('--run_path', type=str, default=None, help='TREC run to rerank instead of synthetic data.')
+    parser.add_argument('--qrels', type=str, default=None, help='TREC qrels that judge --run_path.')
+    parser.add_argument('--save_path', type=str, default=None, help='Path to save the results table (TSV).')
+    args = parser.parse_args()
+    if (args.run_path is None) != (args.qrels is None):
+        raise ValueError('--run_path and --qrels must be given together.')
+    main(args)
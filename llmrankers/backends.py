@@ -0,0 +1,491 @@
+from dataclasses import dataclass
+from typing import List, Union, Dict, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import math
+import os
+import random
+import re
+import time
+import torch
+import tiktoken
+from transformers import T5Tokenizer, T5ForConditionalGeneration, AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers import LogitsProcessor, LogitsProcessorList
+from .constrained import LabelLogitsProcessor, label_logit_bias
+from .cpu import model_dtype, optimize_model
+try:
+    from vllm import LLM, SamplingParams
+    from vllm.lora.request import LoRARequest
+except ImportError:
+    print("Seems vllm is not installed, VllmBackend is not available.")
+
+# A prompt is either plain text or a list of chat messages ({'role': ..., 'content': ...}).
+Prompt = Union[str, List[Dict[str, str]]]
+
+
+@dataclass
+class Generation:
+    text: str
+    prompt_tokens: int
+    completion_tokens: int
+
+
+@dataclass
+class LabelScores:
+    scores: List[float]  # log-probability of each label as the first token of the answer
+    prompt_tokens: int
+
+
+class Backend:
+    """
+    Inference backend used by the Backend*LlmRanker classes. Rankers only build prompts and parse answers; the
+    backend owns the model and turns a batch of prompts into either generated text (generate) or the
+    log-probabilities of a set of answer labels (score_labels). `prefix` is the start of the answer, e.g. "Passage"
+    for "Passage A"; backends that can force it (HF, vLLM) append it to the prompt, the others ignore it. `labels`
+    in generate constrains the answer of every prompt to one of its (single-token) labels.
+    """
+    is_chat = True  # whether prompts are sent as chat conversations
+    tracer = None  # llmrankers.tracing.Tracer that receives tokenize / prefill / decode timings
+
+    def _add_timing(self, name: str, seconds: float):
+        if self.tracer is not None:
+            self.tracer.add_timing(name, seconds)
+
+    def batch_generate(self, prompts: List[Prompt], max_new_tokens: int = 128, prefix: str = '',
+                       labels: List[List[str]] = None) -> List[Generation]:
+        raise NotImplementedError
+
+    def batch_score_labels(self, prompts: List[Prompt], labels: List[List[str]], prefix: str = '') -> List[LabelScores]:
+        raise NotImplementedError
+
+    def generate(self, prompt: Prompt, max_new_tokens: int = 128, prefix: str = '',
+                 labels: List[str] = None) -> Generation:
+        return self.batch_generate([prompt], max_new_tokens=max_new_tokens, prefix=prefix,
+                                   labels=[labels] if labels is not None else None)[0]
+
+    def score_labels(self, prompt: Prompt, labels: List[str], prefix: str = '') -> LabelScores:
+        return self.batch_score_labels([prompt], [labels], prefix=prefix)[0]
+
+    def truncate(self, text, length):
+        raise NotImplementedError
+
+
+def _messages(prompt: Prompt, system_prompt: Optional[str] = None) -> List[Dict[str, str]]:
+    if isinstance(prompt, str):
+        prompt = [{"role": "user", "content": prompt}]
+    if system_prompt is not None and prompt[0]['role'] != 'system':
+        prompt = [{"role": "system", "content": system_prompt}] + prompt
+    return prompt
+
+
+def _prompt_text(prompt: Prompt) -> str:
+    if isinstance(prompt, str):
+        return prompt
+    return "\n\n".join(message['content'] for message in prompt)
+
+
+class _FirstStepTimer(LogitsProcessor):
+    # Called once per decoding step; the first call happens right after the prefill forward pass.
+    def __init__(self):
+        self.first_step = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_step is None:
+            self.first_step = time.perf_counter()
+        return scores
+
+
+class HfBackend(Backend):
+    def __init__(self, model_name_or_path, tokenizer_name_or_path=None, device='cuda', cache_dir=None, batch_size=8,
+                 cpu_precision='fp32', torch_compile=False):
+        self.device = device
+        self.batch_size = batch_size
+        self.config = AutoConfig.from_pretrained(model_name_or_path, cache_dir=cache_dir)
+        tokenizer_name_or_path = tokenizer_name_or_path if tokenizer_name_or_path is not None else model_name_or_path
+        if self.config.model_type == 't5':
+            self.is_chat = False
+            self.tokenizer = T5Tokenizer.from_pretrained(tokenizer_name_or_path, cache_dir=cache_dir)
+            self.llm = T5ForConditionalGeneration.from_pretrained(model_name_or_path,
+                                                                  device_map='auto',
+                                                                  torch_dtype=model_dtype(device, cpu_precision),
+                                                                  cache_dir=cache_dir)
+            self.llm = optimize_model(self.llm, device, cpu_precision, torch_compile)
+        else:
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path, cache_dir=cache_dir)
+            self.tokenizer.use_default_system_prompt = False
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            # left padding so that the answer starts at the same position in every row
+            self.tokenizer.padding_side = 'left'
+            self.is_chat = self.tokenizer.chat_template is not None
+            self.llm = AutoModelForCausalLM.from_pretrained(model_name_or_path,
+                                                            device_map='auto',
+                                                            torch_dtype=model_dtype(device, cpu_precision),
+                                                            cache_dir=cache_dir).eval()
+            self.llm = optimize_model(self.llm, device, cpu_precision, torch_compile)
+
+    def _input_text(self, prompt: Prompt, prefix: str) -> str:
+        if self.config.model_type == 't5':
+            return _prompt_text(prompt)
+        if self.is_chat:
+            text = self.tokenizer.apply_chat_template(_messages(prompt), tokenize=False, add_generation_prompt=True)
+        else:
+            text = _prompt_text(prompt)
+        return text + f" {prefix}" if prefix else text
+
+    def _decoder_input_ids(self, prefix: str, batch_size: int):
+        # t5 decoding starts with <pad>, followed by the forced answer prefix
+        return self.tokenizer.encode(f"<pad> {prefix}" if prefix else "<pad>",
+                                     return_tensors="pt",
+                                     add_special_tokens=False).to(self.llm.device).repeat(batch_size, 1)
+
+    def _label_token_id(self, label: str, prefix: str) -> int:
+        return self.tokenizer.encode(f"{prefix} {label}" if prefix else label, add_special_tokens=False)[-1]
+
+    def _label_processor(self, labels: List[List[str]], prefix: str, start: int) -> LabelLogitsProcessor:
+        return LabelLogitsProcessor([[self._label_token_id(label, prefix) for label in row_labels]
+                                     for row_labels in labels], start, self.tokenizer.eos_token_id)
+
+    def batch_generate(self, prompts: List[Prompt], max_new_tokens: int = 128, prefix: str = '',
+                       labels: List[List[str]] = None) -> List[Generation]:
+        generations = []
+        for start in range(0, len(prompts), self.batch_size):
+            tic = time.perf_counter()
+            texts = [self._input_text(prompt, prefix) for prompt in prompts[start: start + self.batch_size]]
+            inputs = self.tokenizer(texts, return_tensors="pt", padding=True).to(self.llm.device)
+            prompt_tokens = inputs.attention_mask.sum(dim=1).tolist()
+            self._add_timing('tokenize', time.perf_counter() - tic)
+
+            timer = _FirstStepTimer() if self.tracer is not None else None
+            processors = [timer] if timer else []
+            tic = time.perf_counter()
+            with torch.no_grad():
+                if self.config.model_type == 't5':
+                    decoder_input_ids = self._decoder_input_ids(prefix, len(texts))
+                    if labels is not None:
+                        processors.append(self._label_processor(labels[start: start + self.batch_size], prefix,
+                                                                decoder_input_ids.shape[1]))
+                    output_ids = self.llm.generate(**inputs,
+                                                   decoder_input_ids=decoder_input_ids,
+                                                   max_new_tokens=max_new_tokens,
+                                                   logits_processor=LogitsProcessorList(processors)
+                                                   if processors else None)
+                    output_ids = output_ids[:, decoder_input_ids.shape[1]:]
+                else:
+                    if labels is not None:
+                        processors.append(self._label_processor(labels[start: start + self.batch_size], prefix,
+                                                                inputs.input_ids.shape[1]))
+                    output_ids = self.llm.generate(**inputs,
+                                                   do_sample=False,
+                                                   temperature=0.0,
+                                                   top_p=None,
+                                                   max_new_tokens=max_new_tokens,
+                                                   pad_token_id=self.tokenizer.pad_token_id,
+                                                   logits_processor=LogitsProcessorList(processors)
+                                                   if processors else None)
+                    output_ids = output_ids[:, inputs.input_ids.shape[1]:]
+            toc = time.perf_counter()
+            if timer is not None and timer.first_step is not None:
+                self._add_timing('prefill', timer.first_step - tic)
+                self._add_timing('decode', toc - timer.first_step)
+            completion_tokens = (output_ids != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+            for text, num_prompt, num_completion in zip(self.tokenizer.batch_decode(output_ids,
+                                                                                    skip_special_tokens=True),
+                                                        prompt_tokens, completion_tokens):
+                generations.append(Generation(text=text, prompt_tokens=num_prompt, completion_tokens=num_completion))
+        return generations
+
+    def batch_score_labels(self, prompts: List[Prompt], labels: List[List[str]], prefix: str = '') -> List[LabelScores]:
+        results = []
+        for start in range(0, len(prompts), self.batch_size):
+            tic = time.perf_counter()
+            texts = [self._input_text(prompt, prefix) for prompt in prompts[start: start + self.batch_size]]
+            inputs = self.tokenizer(texts, return_tensors="pt", padding=True).to(self.llm.device)
+            prompt_tokens = inputs.attention_mask.sum(dim=1).tolist()
+            self._add_timing('tokenize', time.perf_counter() - tic)
+
+            # a single forward pass: all of it is prefill
+            tic = time.perf_counter()
+            with torch.no_grad():
+                if self.config.model_type == 't5':
+                    logits = self.llm(**inputs, decoder_input_ids=self._decoder_input_ids(prefix, len(texts))).logits
+                else:
+                    logits = self.llm(**inputs).logits
+                log_probs = torch.log_softmax(logits[:, -1].float(), dim=-1)
+            self._add_timing('prefill', time.perf_counter() - tic)
+            for row, row_labels, num_prompt in zip(log_probs, labels[start: start + self.batch_size], prompt_tokens):
+                ids = [self._label_token_id(label, prefix) for label in row_labels]
+                results.append(LabelScores(scores=row[ids].tolist(), prompt_tokens=num_prompt))
+        return results
+
+    def truncate(self, text, length):
+        return self.tokenizer.convert_tokens_to_string(self.tokenizer.tokenize(text)[:length])
+
+
+class VllmBackend(Backend):
+    def __init__(self, model_name_or_path, tokenizer_name_or_path=None, lora_path=None, cache_dir=None):
+        if tokenizer_name_or_path is None:
+            tokenizer_name_or_path = model_name_or_path
+        self.lora_path = lora_path
+        self.llm = LLM(model=model_name_or_path,
+                       tokenizer=tokenizer_name_or_path,
+                       download_dir=cache_dir,
+                       enable_lora=True if lora_path is not None else False,
+                       max_lora_rank=32,
+                       )
+        self.tokenizer = self.llm.get_tokenizer()
+        self.is_chat = self.tokenizer.chat_template is not None
+
+    def _input_text(self, prompt: Prompt, prefix: str) -> str:
+        if self.is_chat:
+            text = self.tokenizer.apply_chat_template(_messages(prompt), tokenize=False, add_generation_prompt=True)
+        else:
+            text = _prompt_text(prompt)
+        return text + f" {prefix}" if prefix else text
+
+    def _generate(self, prompts: List[Prompt], sampling_params, prefix: str):
+        # all prompts go to vLLM in one call, which schedules them with continuous batching
+        outputs = self.llm.generate([self._input_text(prompt, prefix) for prompt in prompts],
+                                    sampling_params=sampling_params,
+                                    use_tqdm=False,
+                                    lora_request=LoRARequest("adapter", 1, self.lora_path)
+                                    if self.lora_path is not None else None)
+        if self.tracer is not None:
+            # vLLM request metrics, when available: time to first token is prefill (plus queueing), the rest decode
+            metrics = [getattr(output, 'metrics', None) for output in outputs]
+            metrics = [m for m in metrics if m is not None and getattr(m, 'first_token_time', None)
+                       and getattr(m, 'first_scheduled_time', None) and getattr(m, 'finished_time', None)]
+            if metrics:
+                self._add_timing('prefill', max(m.first_token_time - m.first_scheduled_time for m in metrics))
+                self._add_timing('decode', max(m.finished_time - m.first_token_time for m in metrics))
+        return outputs
+
+    def batch_generate(self, prompts: List[Prompt], max_new_tokens: int = 128, prefix: str = '',
+                       labels: List[List[str]] = None) -> List[Generation]:
+        if labels is not None:
+            # one decoding step restricted to the label tokens of every prompt
+            sampling_params = [SamplingParams(temperature=0.0, max_tokens=1,
+                                              allowed_token_ids=sorted(set(self._label_token_id(label, prefix)
+                                                                           for label in row_labels)))
+                               for row_labels in labels]
+        else:
+            sampling_params = SamplingParams(temperature=0.0, max_tokens=max_new_tokens)
+        outputs = self._generate(prompts, sampling_params, prefix)
+        return [Generation(text=output.outputs[0].text,
+                           prompt_tokens=len(output.prompt_token_ids),
+                           completion_tokens=len(output.outputs[0].token_ids)) for output in outputs]
+
+    def _label_token_id(self, label: str, prefix: str) -> int:
+        return self.tokenizer.encode(f"{prefix} {label}" if prefix else label, add_special_tokens=False)[-1]
+
+    def batch_score_labels(self, prompts: List[Prompt], labels: List[List[str]], prefix: str = '') -> List[LabelScores]:
+        label_ids = [[self._label_token_id(label, prefix) for label in row_labels] for row_labels in labels]
+        # One decoding step restricted to the label tokens of every prompt, all prompts in one call; the returned
+        # logprobs then cover every label.
+        sampling_params = [SamplingParams(temperature=0.0, max_tokens=1, logprobs=len(set(ids)),
+                                          allowed_token_ids=sorted(set(ids))) for ids in label_ids]
+        results = []
+        for output, ids in zip(self._generate(prompts, sampling_params, prefix), label_ids):
+            logprobs = output.outputs[0].logprobs[0]
+            results.append(LabelScores(scores=[logprobs[i].logprob if i in logprobs else -math.inf for i in ids],
+                                       prompt_tokens=len(output.prompt_token_ids)))
+        return results
+
+    def truncate(self, text, length):
+        return self.tokenizer.convert_tokens_to_string(self.tokenizer.tokenize(text)[:length])
+
+
+class OpenAiBackend(Backend):
+    """
+    Any server that speaks the OpenAI chat completions API (OpenAI, vLLM serve, TGI, llama.cpp, ...). Requests of a
+    batch are sent concurrently with num_workers threads. score_labels needs a server that returns top logprobs, and
+    no answer prefix: the chat API cannot force "Passage", so the first token would never be the label itself.
+    """
+    def __init__(self, model_name_or_path, api_key=None, base_url=None, system_prompt=None, num_workers=1,
+                 top_logprobs=20):
+        from openai import OpenAI
+        self.llm = model_name_or_path
+        self.client = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY", "EMPTY"), base_url=base_url)
+        self.system_prompt = system_prompt
+        self.num_workers = num_workers
+        self.top_logprobs = top_logprobs
+        self.known_tokenizer = True
+        try:
+            self.tokenizer = tiktoken.encoding_for_model(model_name_or_path)
+        except KeyError:
+            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+            self.known_tokenizer = False
+
+    def _request(self, prompt: Prompt, **kwargs):
+        import openai
+        while True:
+            try:
+                return self.client.chat.completions.create(model=self.llm,
+                                                           messages=_messages(prompt, self.system_prompt),
+                                                           temperature=0.0,
+                                                           **kwargs)
+            except (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError) as e:
+                print(f"OpenAI API request failed, retrying: {e}")
+                time.sleep(5)
+
+    def _map(self, fn, items):
+        if self.num_workers <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            return list(executor.map(fn, items))
+
+    def _label_kwargs(self, row_labels: List[str], prefix: str, max_new_tokens: int) -> Dict:
+        # Constrained answer: a logit bias on the label tokens for OpenAI models (whose tokenizer tiktoken knows),
+        # guided choice for other servers (vLLM serve).
+        if self.known_tokenizer:
+            return {'max_tokens': 1, 'logit_bias': label_logit_bias(self.tokenizer, row_labels)}
+        return {'max_tokens': max_new_tokens,
+                'extra_body': {'guided_choice': [f"{prefix} {label}" if prefix else label for label in row_labels]}}
+
+    def batch_generate(self, prompts: List[Prompt], max_new_tokens: int = 128, prefix: str = '',
+                       labels: List[List[str]] = None) -> List[Generation]:
+        def generate(item):
+            prompt, row_labels = item
+            kwargs = self._label_kwargs(row_labels, prefix, max_new_tokens) if row_labels is not None else \
+                {'max_tokens': max_new_tokens}
+            response = self._request(prompt, **kwargs)
+            return Generation(text=response.choices[0].message.content or "",
+                              prompt_tokens=response.usage.prompt_tokens,
+                              completion_tokens=response.usage.completion_tokens)
+        return self._map(generate, list(zip(prompts, labels if labels is not None else [None] * len(prompts))))
+
+    def batch_score_labels(self, prompts: List[Prompt], labels: List[List[str]], prefix: str = '') -> List[LabelScores]:
+        if prefix:
+            raise NotImplementedError(f'OpenAiBackend cannot force the answer prefix "{prefix}", so label scores '
+                                      f'would all be -inf; use --scoring generation.')
+
+        def score(item):
+            prompt, row_labels = item
+            response = self._request(prompt, max_tokens=1, logprobs=True, top_logprobs=self.top_logprobs)
+            logprobs = {}
+            for candidate in response.choices[0].logprobs.content[0].top_logprobs:
+                logprobs.setdefault(candidate.token.strip(), candidate.logprob)
+            return LabelScores(scores=[logprobs.get(label, -math.inf) for label in row_labels],
+                               prompt_tokens=response.usage.prompt_tokens)
+        return self._map(score, list(zip(prompts, labels)))
+
+    def truncate(self, text, length):
+        return self.tokenizer.decode(self.tokenizer.encode(text)[:length])
+
+
+class StubBackend(Backend):
+    """
+    Deterministic stand-in for an LLM, for running the ranking algorithms on CPU. It finds the labelled passages in
+    the prompt ("Passage A: ..." or "[1] ...") and answers as if its relevance judgement of a passage were
+    relevance_fn(passage_text) plus seeded gaussian noise. By default relevance is a hash of the passage text, so
+    the stub is a consistent (noise=0) or noisy judge. Prompts without passage labels (pointwise "Passage: ..." or
+    "Document: ...") are judged as a single passage and the first label (e.g. "Yes") gets its relevance. Every
+    batch sleeps `latency` seconds plus `token_latency` seconds per prompt token, a rough model of a forward pass.
+    Tokens are counted as whitespace separated words.
+    """
+    is_chat = True
+    PASSAGE_PATTERN = re.compile(r'Passage ([A-Z])\b:?|\[(\d+)\]')
+    SINGLE_PASSAGE_PATTERN = re.compile(r'(?:Passage|Document): (.*?)(?:\n| Relevant:|$)')
+
+    def __init__(self, relevance_fn: Callable[[str], float] = None, noise: float = 0.0, seed: int = 929,
+                 latency: float = 0.0, token_latency: float = 0.0):
+        self.relevance_fn = relevance_fn if relevance_fn is not None else self._hash_relevance
+        self.noise = noise
+        self.seed = seed
+        self.latency = latency
+        self.token_latency = token_latency
+        self.tokenizer = None
+
+    def _sleep(self, prompts: List[Prompt]):
+        delay = self.latency
+        if self.token_latency > 0:
+            delay += self.token_latency * sum(len(_prompt_text(prompt).split()) for prompt in prompts)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _hash_relevance(self, text: str) -> float:
+        return int(hashlib.md5(f'{self.seed}:{text}'.encode()).hexdigest()[:8], 16) / 0xffffffff
+
+    def _judge(self, text: str, key: str) -> float:
+        relevance = self.relevance_fn(text)
+        if self.noise > 0:
+            relevance += random.Random(f'{self.seed}:{key}').gauss(0, self.noise)
+        return relevance
+
+    def passages(self, text: str) -> Dict[str, str]:
+        # label -> passage text, for the first occurrence of every label; a passage ends at the next label or at
+        # the first blank line
+        markers = list(self.PASSAGE_PATTERN.finditer(text))
+        passages = {}
+        for marker, next_marker in zip(markers, markers[1:] + [None]):
+            label = marker.group(1) or f'[{marker.group(2)}]'
+            if label in passages:
+                continue
+            content = text[marker.end(): next_marker.start() if next_marker is not None else len(text)]
+            content = content.strip().split('\n\n')[0]
+            content = re.sub(r'</?doc_content>', '', content).strip().strip('"').strip()
+            passages[label] = content
+        return passages
+
+    def _single_passage(self, text: str) -> str:
+        match = self.SINGLE_PASSAGE_PATTERN.search(text)
+        return match.group(1).strip() if match else text
+
+    def _relevance(self, prompt: Prompt) -> Dict[str, float]:
+        text = _prompt_text(prompt)
+        return {label: self._judge(content, f'{text}:{label}') for label, content in self.passages(text).items()}
+
+    def batch_generate(self, prompts: List[Prompt], max_new_tokens: int = 128, prefix: str = '',
+                       labels: List[List[str]] = None) -> List[Generation]:
+        self._sleep(prompts)
+        generations = []
+        for i, prompt in enumerate(prompts):
+            text = _prompt_text(prompt)
+            relevance = self._relevance(prompt)
+            if labels is not None and relevance:
+                # constrained: only the given labels can be the answer
+                relevance = {label: relevance.get(label, relevance.get(f'[{j + 1}]', -math.inf))
+                             for j, label in enumerate(labels[i])}
+            if not relevance:
+                output = "Yes" if self._judge(self._single_passage(text), text) >= 0.5 else "No"
+            elif all(label.startswith('[') for label in relevance):
+                output = " > ".join(sorted(relevance, key=relevance.get, reverse=True))
+            else:
+                output = f"Passage {max(relevance, key=relevance.get)}"
+            generations.append(Generation(text=output, prompt_tokens=len(text.split()),
+                                          completion_tokens=len(output.split())))
+        return generations
+
+    def batch_score_labels(self, prompts: List[Prompt], labels: List[List[str]], prefix: str = '') -> List[LabelScores]:
+        self._sleep(prompts)
+        results = []
+        for prompt, row_labels in zip(prompts, labels):
+            text = _prompt_text(prompt)
+            relevance = self._relevance(prompt)
+            if relevance:
+                scores = [relevance.get(label, relevance.get(f'[{i + 1}]', -math.inf))
+                          for i, label in enumerate(row_labels)]
+            else:
+                judgement = self._judge(self._single_passage(text), text)
+                scores = [judgement if i == 0 else 1 - judgement for i in range(len(row_labels))]
+            results.append(LabelScores(scores=scores, prompt_tokens=len(text.split())))
+        return results
+
+    def truncate(self, text, length):
+        return ' '.join(text.split()[:length])
+
+
+def load_backend(name, model_name_or_path=None, tokenizer_name_or_path=None, device='cuda', cache_dir=None,
+                 api_key=None, base_url=None, batch_size=8, num_workers=1, cpu_precision='fp32', torch_compile=False):
+    if name == 'hf':
+        return HfBackend(model_name_or_path, tokenizer_name_or_path, device=device, cache_dir=cache_dir,
+                         batch_size=batch_size, cpu_precision=cpu_precision, torch_compile=torch_compile)
+    elif name == 'vllm':
+        return VllmBackend(model_name_or_path, tokenizer_name_or_path, cache_dir=cache_dir)
+    elif name == 'openai':
+        return OpenAiBackend(model_name_or_path, api_key=api_key, base_url=base_url, num_workers=num_workers)
+    elif name == 'stub':
+        return StubBackend()
+    else:
+        raise ValueError(f'Invalid backend: {name}.')
@@ -0,0 +1,244 @@
+import functools
+import math
+from typing import List, Optional
+from .rankers import SearchResult
+from .pairwise import DuoT5LlmRanker
+from .cascade import CascadeLlmRanker
+
+
+def estimate_compares(ranker, n: int) -> int:
+    """Rough upper bound on the model calls (as counted in ranker.total_compare) needed to rerank n candidates."""
+    if n <= 1:
+        return 0
+    method = getattr(ranker, 'method', None)
+    k = min(getattr(ranker, 'k', n), n)
+    if hasattr(ranker, 'window_size'):  # listwise
+        window, step = ranker.window_size, max(ranker.step_size, 1)
+        if n <= window:
+            return 1 if n == window or method == 'tournament' else 0  # a short sliding pass makes no call
+        if method == 'tournament':
+            promote = max(window - step, 1)
+            calls = 0
+            while n > window:
+                windows = math.ceil(n / window)
+                calls += windows
+                n = sum(min(promote, n - i * window) for i in range(windows))
+            return calls + (1 if n > 1 else 0)
+        return ranker.num_repeat * ((n - window) // step + 1)
+    if hasattr(ranker, 'num_child'):  # setwise
+        c = ranker.num_child
+        if method == 'bubblesort':
+            return k * math.ceil((n - 1) / c)
+        depth = max(1, math.ceil(math.log(n, c + 1)))
+        return n // c + 1 + k * depth
+    if method == 'allpair':
+        return math.ceil(n * (n - 1) / max(getattr(ranker, 'batch_size', 2), 1))
+    if method == 'bradley_terry':
+        max_pairs = ranker.max_pairs if ranker.max_pairs is not None else n * (n - 1) // 2
+        return math.ceil(min(max_pairs, n * (n - 1) // 2) / max(ranker.batch_size // 2, 1))
+    if method == 'bubblesort':
+        return k * (n - 1)
+    if method == 'heapsort':  # pairwise
+        return n // 2 + 1 + 2 * k * max(1, math.ceil(math.log2(n)))
+    # pointwise scores every candidate once
+    return math.ceil(n / max(getattr(ranker, 'batch_size', 1), 1))
+
+
+def docs_per_compare(ranker, n: int) -> int:
+    if hasattr(ranker, 'window_size'):
+        return min(ranker.window_size, n)
+    if hasattr(ranker, 'num_child'):
+        return min(ranker.num_child + 1, n)
+    if getattr(ranker, 'method', None) in ('allpair', 'bradley_terry'):
+        return 2 * max(getattr(ranker, 'batch_size', 2), 1)
+    if getattr(ranker, 'method', None) in ('heapsort', 'bubblesort'):
+        return 4  # two prompts with two passages each
+    return max(getattr(ranker, 'batch_size', 1), 1)
+
+
+class BudgetController:
+    """
+    Per-query budget on model calls (max_compare, in the units of ranker.total_compare) and/or prompt + completion
+    tokens (max_tokens). Before a query it plans how many first-stage candidates enter the ranker, and may first
+    raise num_child (setwise, up to max_num_child) or window_size and step_size together (listwise, up to
+    max_window_size) so that the estimated cost fits. The token cost of a comparison is
+    learned from the rankers' own counters over the previous queries. If a query still runs out of budget, the
+    remaining comparisons are answered from the first-stage order instead of the model, so the sort always
+    finishes; candidates that did not enter the ranker follow in first-stage order.
+
+    For a CascadeLlmRanker the prefilter always scores all candidates and is not charged to the budget (its cost is
+    in prefilter_compare / prefilter_prompt_tokens); the budget plans and guards the expensive ranker on the top_m
+    head, and fallbacks follow the prefilter order.
+
+        budget = BudgetController(max_compare=50)
+        results = budget.rerank(ranker, query, ranking)
+    """
+    GUARDED_METHODS = ['compare', 'batch_compare', 'compare_batch']
+
+    def __init__(self, max_compare: Optional[int] = None, max_tokens: Optional[int] = None,
+                 max_num_child: Optional[int] = None, max_window_size: Optional[int] = None):
+        self.max_compare = max_compare
+        self.max_tokens = max_tokens
+        self.max_num_child = max_num_child
+        self.max_window_size = max_window_size
+        self.tokens_per_doc = None  # prompt + completion tokens per passage in a comparison, learned
+        self.fallbacks = 0  # comparisons answered from the first-stage order in the last query
+        self.num_candidates = None  # candidates that entered the ranker in the last query
+
+    def _estimate_tokens(self, ranker, n: int, ranking: List[SearchResult]) -> float:
+        tokens_per_doc = self.tokens_per_doc
+        if tokens_per_doc is None:
+            # before any feedback: ~1.3 tokens per word plus some prompt overhead
+            tokens_per_doc = 1.3 * sum(len(doc.text.split()) for doc in ranking[:n]) / max(n, 1) + 20
+        return estimate_compares(ranker, n) * docs_per_compare(ranker, n) * tokens_per_doc
+
+    def _fits(self, ranker, n: int, ranking: List[SearchResult]) -> bool:
+        if self.max_compare is not None and estimate_compares(ranker, n) > self.max_compare:
+            return False
+        if self.max_tokens is not None and self._estimate_tokens(ranker, n, ranking) > self.max_tokens:
+            return False
+        return True
+
+    def plan(self, ranker, ranking: List[SearchResult]) -> int:
+        """Returns the number of candidates to rerank; may adjust ranker.num_child or ranker.window_size."""
+        n = len(ranking)
+        if hasattr(ranker, 'num_child') and self.max_num_child is not None:
+            while not self._fits(ranker, n, ranking) and ranker.num_child < self.max_num_child:
+                ranker.num_child += 1
+        if hasattr(ranker, 'window_size') and self.max_window_size is not None:
+            # keep the overlap between windows, fewer and larger windows cover the candidates
+            while not self._fits(ranker, n, ranking) and ranker.window_size < self.max_window_size:
+                ranker.window_size += 1
+                ranker.step_size += 1
+        low, high = min(n, 1), n
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self._fits(ranker, mid, ranking):
+                low = mid
+            else:
+                high = mid - 1
+        # the ranker needs at least two candidates (and a full window for listwise) to do anything useful
+        return max(low, min(n, 2))
+
+    def _exhausted(self, ranker, calls: int = 1) -> bool:
+        if self.max_compare is not None and ranker.total_compare + calls > self.max_compare:
+            return True
+        if self.max_tokens is not None and \
+                ranker.total_prompt_tokens + ranker.total_completion_tokens >= self.max_tokens:
+            return True
+        return False
+
+    def _fallback(self, ranker, name, args, kwargs, first_stage_rank):
+        # The answer the model would give if it agreed with the first-stage ranking.
+        def rank(doc):
+            if isinstance(doc, str):
+                return first_stage_rank.get(doc, len(first_stage_rank))
+            return first_stage_rank.get(doc.docid, first_stage_rank.get(doc.text, len(first_stage_rank)))
+
+        def best_label(docs):
+            return ranker.CHARACTERS[min(range(len(docs)), key=lambda i: rank(docs[i]), default=0)]
+
+        def permutation(docs):
+            return ' > '.join(f'[{i + 1}]' for i in sorted(range(len(docs)), key=lambda i: rank(docs[i])))
+
+        if name == 'compare':
+            docs = args[1] if len(args) > 1 else kwargs['docs']
+            if hasattr(ranker, 'window_size'):
+                return permutation(docs)
+            if hasattr(ranker, 'num_child'):
+                return best_label(docs)
+            if isinstance(ranker, DuoT5LlmRanker):
+                return rank(docs[0]) < rank(docs[1])
+            # pairwise: both orderings of the pair agree with the first stage
+            return ['Passage A', 'Passage B'] if rank(docs[0]) <= rank(docs[1]) else ['Passage B', 'Passage A']
+        if name == 'compare_batch':
+            return [best_label(docs) for docs, _ in args[1]]
+        if name == 'batch_compare':
+            # a list of (query, docs) requests, each answered like compare
+            return [self._fallback(ranker, 'compare', request, {}, first_stage_rank) for request in args[0]]
+        raise NotImplementedError(name)
+
+    def _guard(self, ranker, first_stage_rank):
+        # Route model calls through the budget; returns the original methods to restore.
+        originals = {}
+        state = {'depth': 0}
+        for name in self.GUARDED_METHODS:
+            if not hasattr(ranker, name):
+                continue
+            method = getattr(ranker, name)
+            originals[name] = ranker.__dict__.get(name)
+
+            def guarded(*args, _name=name, _method=method, **kwargs):
+                if state['depth'] > 0:
+                    return _method(*args, **kwargs)
+                if _name == 'compare':
+                    if self._exhausted(ranker):
+                        self.fallbacks += 1
+                        return self._fallback(ranker, _name, args, kwargs, first_stage_rank)
+                    requests = None
+                else:
+                    requests = args[1] if _name == 'compare_batch' else args[0]
+                    if self._exhausted(ranker, 1):
+                        self.fallbacks += len(requests)
+                        return self._fallback(ranker, _name, args, kwargs, first_stage_rank)
+                state['depth'] += 1
+                try:
+                    if requests is not None and self.max_compare is not None:
+                        # spend what is left on the first requests of the batch, answer the rest from the first stage
+                        allowed = max(self.max_compare - ranker.total_compare, 0)
+                        if allowed < len(requests):
+                            head = list(args)
+                            head[1 if _name == 'compare_batch' else 0] = requests[:allowed]
+                            tail = list(args)
+                            tail[1 if _name == 'compare_batch' else 0] = requests[allowed:]
+                            self.fallbacks += len(requests) - allowed
+                            return _method(*head, **kwargs) + self._fallback(ranker, _name, tail, kwargs,
+                                                                             first_stage_rank)
+                    return _method(*args, **kwargs)
+                finally:
+                    state['depth'] -= 1
+            setattr(ranker, name, functools.wraps(method)(guarded))
+        return originals
+
+    def rerank(self, ranker, query: str, ranking: List[SearchResult], **kwargs) -> List[SearchResult]:
+        if isinstance(ranker, CascadeLlmRanker):
+            return ranker.rerank(query, ranking,
+                                 rerank_head=lambda head_query, head: self.rerank(ranker.ranker, head_query, head,
+                                                                                  **kwargs))
+        self.fallbacks = 0
+        params = {name: getattr(ranker, name) for name in ['num_child', 'window_size', 'step_size']
+                  if hasattr(ranker, name)}
+        n = self.plan(ranker, ranking)
+        self.num_candidates = n
+        per_compare = docs_per_compare(ranker, n)
+        first_stage_rank = {}
+        for i, doc in enumerate(ranking):
+            first_stage_rank.setdefault(doc.docid, i)
+            first_stage_rank.setdefault(doc.text, i)
+
+        originals = self._guard(ranker, first_stage_rank)
+        try:
+            reranked = ranker.rerank(query, ranking[:n], **kwargs)
+        finally:
+            for name, original in originals.items():
+                if original is None:
+                    delattr(ranker, name)
+                else:
+                    setattr(ranker, name, original)
+            for name, value in params.items():
+                setattr(ranker, name, value)
+
+        # learn the token cost of a passage in a comparison from the ranker's counters
+        compares = ranker.total_compare
+        if compares > 0 and self.max_tokens is not None:
+            observed = (ranker.total_prompt_tokens + ranker.total_completion_tokens) / \
+                       (compares * per_compare)
+            self.tokens_per_doc = observed if self.tokens_per_doc is None else \
+                0.5 * self.tokens_per_doc + 0.5 * observed
+
+        results = list(reranked)
+        rank = len(results)
+        for doc in ranking[n:]:
+            rank += 1
+            results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
+        return results
@@ -0,0 +1,59 @@
+import copy
+from typing import Callable, List, Optional
+from .rankers import LlmRanker, SearchResult
+
+
+class CascadeLlmRanker(LlmRanker):
+    """
+    Two-stage reranking: a cheap prefilter (e.g. MonoT5LlmRanker or PointwiseLlmRanker, which score candidates
+    independently in large batches) orders all candidates, and only its top_m are reranked by the expensive ranker
+    (setwise, pairwise or listwise). The candidates below top_m keep the prefilter order.
+
+        ranker = CascadeLlmRanker(MonoT5LlmRanker(...), SetwiseLlmRanker(...), top_m=50)
+        results = ranker.rerank(query, top_1000)
+
+    The counters add up both stages; the prefilter's share is kept in prefilter_compare / prefilter_prompt_tokens.
+    rerank_head, if given, is called instead of ranker.rerank on the top_m head (BudgetController uses it to plan and
+    guard the expensive stage only).
+    """
+    def __init__(self, prefilter: LlmRanker, ranker: LlmRanker, top_m: int = 50):
+        self.prefilter = prefilter
+        self.ranker = ranker
+        self.stages = [prefilter, ranker]
+        self.top_m = top_m
+
+        self.total_compare = 0
+        self.total_completion_tokens = 0
+        self.total_prompt_tokens = 0
+        self.prefilter_compare = 0
+        self.prefilter_prompt_tokens = 0
+
+    def rerank(self, query: str, ranking: List[SearchResult],
+               rerank_head: Optional[Callable[[str, List[SearchResult]], List[SearchResult]]] = None
+               ) -> List[SearchResult]:
+        # pointwise rankers write their scores into the given results, so they get copies
+        prefiltered = self.prefilter.rerank(query, [copy.copy(doc) for doc in ranking])
+        self.prefilter_compare = self.prefilter.total_compare
+        self.prefilter_prompt_tokens = self.prefilter.total_prompt_tokens
+
+        texts = {doc.docid: doc.text for doc in ranking}
+        head = [SearchResult(docid=doc.docid, score=doc.score, text=texts[doc.docid])
+                for doc in prefiltered[:self.top_m]]
+        reranked = (rerank_head or self.ranker.rerank)(query, head)
+
+        self.total_compare = self.prefilter.total_compare + self.ranker.total_compare
+        self.total_completion_tokens = self.prefilter.total_completion_tokens + self.ranker.total_completion_tokens
+        self.total_prompt_tokens = self.prefilter.total_prompt_tokens + self.ranker.total_prompt_tokens
+
+        results = []
+        rank = 1
+        for doc in reranked:
+            results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
+            rank += 1
+        for doc in prefiltered[self.top_m:]:
+            results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
+            rank += 1
+        return results
+
+    def truncate(self, text, length):
+        return self.ranker.truncate(text, length)
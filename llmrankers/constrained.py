@@ -0,0 +1,39 @@
+from typing import Dict, List
+import torch
+from transformers import LogitsProcessor
+
+
+class LabelLogitsProcessor(LogitsProcessor):
+    """
+    Constrained decoding of a single-token answer label with HuggingFace generate: the first generated token of
+    every row can only be one of that row's label token ids (one list for all rows, or one list per row), and every
+    later token is eos. The answer is then always a valid label and never needs a fallback. `start` is the sequence
+    length before the first generated token, i.e. the decoder prefix for T5 and the padded prompt for causal models.
+    """
+    def __init__(self, allowed_token_ids: List[List[int]], start: int, eos_token_id: int = None):
+        self.allowed_token_ids = allowed_token_ids
+        self.start = start
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        mask = torch.full_like(scores, -float('inf'))
+        if input_ids.shape[1] <= self.start:
+            for row in range(scores.shape[0]):
+                allowed = self.allowed_token_ids[row if len(self.allowed_token_ids) > 1 else 0]
+                mask[row, allowed] = 0
+        elif self.eos_token_id is not None:
+            mask[:, self.eos_token_id] = 0
+        else:
+            return scores
+        return scores + mask
+
+
+def label_logit_bias(encoding, labels: List[str]) -> Dict[int, int]:
+    # OpenAI logit_bias that lets only the labels through (with or without a leading space); use with max_tokens=1.
+    bias = {}
+    for label in labels:
+        for text in [label, f' {label}']:
+            token_ids = encoding.encode(text)
+            if len(token_ids) == 1:
+                bias[token_ids[0]] = 100
+    return bias
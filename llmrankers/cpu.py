@@ -0,0 +1,29 @@
+import torch
+
+# Precision of HF models on CPU: full fp32 (the default), bf16 weights and activations, or fp32 with the Linear
+# layers dynamically quantized to int8 (weights stored in int8, activations quantized on the fly per batch).
+CPU_PRECISIONS = ['fp32', 'bf16', 'int8']
+
+
+def model_dtype(device: str, cpu_precision: str = 'fp32'):
+    # torch_dtype for from_pretrained: fp16 on GPU; on CPU bf16 if asked, otherwise fp32 (int8 quantizes fp32 weights)
+    if cpu_precision not in CPU_PRECISIONS:
+        raise ValueError(f'Invalid cpu_precision: {cpu_precision}.')
+    if device == 'cuda':
+        if cpu_precision != 'fp32':
+            print(f"cpu_precision={cpu_precision} only applies to CPU inference, loading the model in fp16.")
+        return torch.float16
+    return torch.bfloat16 if cpu_precision == 'bf16' else torch.float32
+
+
+def optimize_model(model, device: str, cpu_precision: str = 'fp32', torch_compile: bool = False):
+    """
+    Prepares a loaded HF model for inference: on CPU with cpu_precision='int8', replaces its nn.Linear layers by
+    dynamically quantized int8 ones (in place); with torch_compile, compiles its forward (dynamic shapes, so that
+    batches of different lengths do not recompile). Returns the model.
+    """
+    if device != 'cuda' and cpu_precision == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if torch_compile:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+
+class EncoderCache:
+    """
+    LRU cache of T5 encoder outputs, keyed by the token ids of every input row (padding excluded). The rankers only
+    decode one or two tokens, so the encoder is nearly the whole cost of a call; repeated inputs (the same window
+    again with num_repeat, a pair or set compared again during sorting) skip it. Returns the keyword arguments of
+    a generate / forward call, with the encoder outputs of the batch right-padded and a matching attention mask:
+
+        cache = EncoderCache(model, max_size=1024)
+        output_ids = model.generate(**cache(input_ids, attention_mask), max_new_tokens=2)
+    """
+    def __init__(self, model, max_size: int = 1024):
+        self.model = model
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _encode(self, rows):
+        # rows: token id lists; returns the encoder hidden states of every row without padding
+        length = max(len(row) for row in rows)
+        device = self.model.device
+        input_ids = torch.zeros((len(rows), length), dtype=torch.long, device=device)
+        attention_mask = torch.zeros((len(rows), length), dtype=torch.long, device=device)
+        for i, row in enumerate(rows):
+            input_ids[i, :len(row)] = torch.tensor(row, dtype=torch.long, device=device)
+            attention_mask[i, :len(row)] = 1
+        with torch.no_grad():
+            hidden = self.model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        return [hidden[i, :len(row)].clone() for i, row in enumerate(rows)]
+
+    def __call__(self, input_ids, attention_mask=None, tracer=None):
+        if attention_mask is None:
+            # like generate without a mask: pad tokens are not attended to and are not part of the key
+            attention_mask = (input_ids != self.model.config.pad_token_id).long()
+        keys = [tuple(ids[mask.bool()].tolist()) for ids, mask in zip(input_ids, attention_mask)]
+        missing = list(dict.fromkeys(key for key in keys if key not in self._cache))
+        hits = len(keys) - len(missing)
+        self.hits += hits
+        self.misses += len(missing)
+        if tracer is not None:
+            tracer.add_cache(True, hits)
+            tracer.add_cache(False, len(missing))
+
+        states = {key: self._cache[key] for key in keys if key in self._cache}
+        if missing:
+            states.update(zip(missing, self._encode(missing)))
+        for key in keys:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            else:
+                self._cache[key] = states[key]
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        length = max(len(key) for key in keys)
+        first = states[keys[0]]
+        hidden = first.new_zeros((len(keys), length, first.shape[-1]))
+        mask = torch.zeros((len(keys), length), dtype=torch.long, device=first.device)
+        for i, key in enumerate(keys):
+            hidden[i, :len(key)] = states[key]
+            mask[i, :len(key)] = 1
+        return {'encoder_outputs': BaseModelOutput(last_hidden_state=hidden), 'attention_mask': mask}
@@ -1,7 +1,12 @@
 import tiktoken
 from .rankers import LlmRanker, SearchResult
-from typing import List
+from .encoder_cache import EncoderCache
+from .cpu import model_dtype, optimize_model
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import functools
+import re
 import openai
 import torch
 from transformers import T5Tokenizer, T5ForConditionalGeneration, AutoTokenizer, AutoModelForCausalLM, AutoConfig
@@ -26,25 +31,33 @@ def get_prefix_prompt(query, num):
             {'role': 'assistant', 'content': 'Okay, please provide the passages.'}]
 
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
-    """Returns the number of tokens used by a list of messages."""
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        return tiktoken.get_encoding(model)
+    except:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def get_message_token_params(model):
+    """Returns the (model, tokens_per_message, tokens_per_name) used to count chat tokens."""
     if model == "gpt-3.5-turbo":
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301")
+        model = "gpt-3.5-turbo-0301"
     elif model == "gpt-4":
-        return num_tokens_from_messages(messages, model="gpt-4-0314")
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
+        model = "gpt-4-0314"
+
+    if model == "gpt-3.5-turbo-0301":
+        return model, 4, -1  # every message follows <|start|>{role/name}\n{content}<|end|>\n; if there's a name, the role is omitted
     elif model == "gpt-4-0314":
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return model, 3, 1
     else:
-        tokens_per_message, tokens_per_name = 0, 0
+        return model, 0, 0
 
-    try:
-        encoding = tiktoken.get_encoding(model)
-    except:
-        encoding = tiktoken.get_encoding("cl100k_base")
+
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens used by a list of messages."""
+    model, tokens_per_message, tokens_per_name = get_message_token_params(model)
+    encoding = get_encoding(model)
 
     num_tokens = 0
     if isinstance(messages, list):
@@ -60,31 +73,62 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
     return num_tokens
 
 
-def create_permutation_instruction_chat(query: str, docs: List[SearchResult], model_name='gpt-3.5-turbo'):
+def create_permutation_instruction_chat(query: str, docs: List[SearchResult], model_name='gpt-3.5-turbo',
+                                        max_length=300):
     num = len(docs)
+    passages = [doc.text.replace('Title: Content: ', '').strip().split() for doc in docs]
 
-    max_length = 300
-    while True:
+    def build_messages(length):
         messages = get_prefix_prompt(query, num)
-        rank = 0
-        for doc in docs:
-            rank += 1
-            content = doc.text
-            content = content.replace('Title: Content: ', '')
-            content = content.strip()
-            # For Japanese should cut by character: content = content[:int(max_length)]
-            content = ' '.join(content.split()[:int(max_length)])
+        for rank, words in enumerate(passages, start=1):
+            # For Japanese should cut by character: content = content[:int(length)]
+            content = ' '.join(words[:length])
             messages.append({'role': 'user', 'content': f"[{rank}] {content}"})
             messages.append({'role': 'assistant', 'content': f'Received passage [{rank}].'})
         messages.append({'role': 'user', 'content': get_post_prompt(query, num)})
-
-        if model_name is not None:
-            if num_tokens_from_messages(messages, model_name) <= max_tokens(model_name) - 200:
-                break
-            else:
-                max_length -= 1
+        return messages
+
+    messages = build_messages(max_length)
+    if model_name is None:
+        return messages
+    budget = max_tokens(model_name) - 200
+    if num_tokens_from_messages(messages, model_name) <= budget:
+        return messages
+
+    # Chat token counts are additive over messages, so only the passage messages change with the per-passage word
+    # cap. Count everything else once (cap 0). tiktoken splits its input before every space, so a passage message
+    # costs the tokens of "[rank]" plus those of " word" for each of its words: every word is encoded once (shared
+    # across passages) into a table of token counts per number of words, and the binary search over the cap only
+    # sums table lookups.
+    encoding = get_encoding(get_message_token_params(model_name)[0])
+    empty_lengths = [len(encoding.encode(f"[{rank}] ")) for rank in range(1, num + 1)]
+    fixed_tokens = num_tokens_from_messages(build_messages(0), model_name) - sum(empty_lengths)
+    word_tokens = {}
+    prefix_tokens = []
+    for rank, words in enumerate(passages, start=1):
+        lengths = [len(encoding.encode(f"[{rank}]"))]
+        for word in words[:max_length]:
+            if word not in word_tokens:
+                word_tokens[word] = len(encoding.encode(f" {word}"))
+            lengths.append(lengths[-1] + word_tokens[word])
+        lengths[0] = empty_lengths[rank - 1]  # "[rank] " with no words
+        prefix_tokens.append(lengths)
+
+    def fits(length):
+        return fixed_tokens + sum(lengths[min(length, len(lengths) - 1)] for lengths in prefix_tokens) <= budget
+
+    low, high = 0, max_length - 1
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(mid):
+            low = mid
         else:
-            break
+            high = mid - 1
+    messages = build_messages(low)
+    # the table is exact for tiktoken; check the chosen cap on the real messages anyway
+    while low > 0 and num_tokens_from_messages(messages, model_name) > budget:
+        low -= 1
+        messages = build_messages(low)
     return messages
 
 
@@ -110,55 +154,42 @@ def create_permutation_instruction_complete(query: str, docs: List[SearchResult]
     return message
 
 
-def clean_response(response: str):
-    new_response = ''
-    for c in response:
-        if not c.isdigit():
-            new_response += ' '
-        else:
-            new_response += c
-    new_response = new_response.strip()
-    return new_response
-
-
-def remove_duplicate(response):
-    new_response = []
-    for c in response:
-        if c not in new_response:
-            new_response.append(c)
-    return new_response
+def parse_permutation(permutation: str, num: int) -> List[int]:
+    """Parses a '[2] > [1] > ...' response into a full permutation of range(num); identifiers that are missing from
+    the response keep their original relative order at the end."""
+    response = dict.fromkeys(int(x) - 1 for x in re.findall(r'\d+', permutation))
+    response = [x for x in response if 0 <= x < num]
+    seen = set(response)
+    return response + [x for x in range(num) if x not in seen]
 
 
 def receive_permutation(ranking, permutation, rank_start=0, rank_end=100):
-    response = clean_response(permutation)
-    response = [int(x) - 1 for x in response.split()]
-    response = remove_duplicate(response)
-    cut_range = copy.deepcopy(ranking[rank_start: rank_end])
-    original_rank = [tt for tt in range(len(cut_range))]
-    response = [ss for ss in response if ss in original_rank]
-    response = response + [tt for tt in original_rank if tt not in response]
-
-    for j, x in enumerate(response):
-        ranking[j + rank_start] = cut_range[x]
-
+    # Reorders ranking[rank_start: rank_end] in place. Items are moved, not copied, so this works the same on a
+    # list of SearchResult or on a list of indices.
+    cut_range = ranking[rank_start: rank_end]
+    ranking[rank_start: rank_start + len(cut_range)] = [cut_range[x] for x in parse_permutation(permutation,
+                                                                                                 len(cut_range))]
     return ranking
 
 
 class OpenAiListwiseLlmRanker(LlmRanker):
-    def __init__(self, model_name_or_path, api_key, window_size, step_size, num_repeat):
+    def __init__(self, model_name_or_path, api_key, window_size, step_size, num_repeat, method='sliding',
+                 num_workers=1):
         self.llm = model_name_or_path
         self.tokenizer = tiktoken.encoding_for_model(model_name_or_path)
         self.window_size = window_size
         self.step_size = step_size
         self.num_repeat = num_repeat
+        self.method = method
+        self.num_workers = num_workers
         openai.api_key = api_key
         self.total_compare = 0
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
 
-    def compare(self, query: str, docs: List):
-        self.total_compare += 1
-        messages = create_permutation_instruction_chat(query, docs, self.llm)
+    def _get_response(self, messages):
+        # Returns (completion text, prompt tokens, completion tokens); counters are updated by the caller so that
+        # this can run in worker threads.
         while True:
             try:
                 completion = openai.ChatCompletion.create(
@@ -166,34 +197,135 @@ class OpenAiListwiseLlmRanker(LlmRanker):
                     messages=messages,
                     temperature=0.0,
                     request_timeout=15)
-                self.total_completion_tokens += int(completion['usage']['completion_tokens'])
-                self.total_prompt_tokens += int(completion['usage']['prompt_tokens'])
-                return completion['choices'][0]['message']['content']
+                return (completion['choices'][0]['message']['content'],
+                        int(completion['usage']['prompt_tokens']),
+                        int(completion['usage']['completion_tokens']))
             except Exception as e:
                 print(str(e))
                 if "This model's maximum context length is" in str(e):
                     print('reduce_length')
-                    return 'ERROR::reduce_length'
+                    return 'ERROR::reduce_length', 0, 0
 
-    def rerank(self,  query: str, ranking: List[SearchResult]) -> List[SearchResult]:
-        self.total_compare = 0
-        self.total_prompt_tokens = 0
-        self.total_completion_tokens = 0
+    def compare(self, query: str, docs: List):
+        self.total_compare += 1
+        messages = create_permutation_instruction_chat(query, docs, self.llm)
+        output, prompt_tokens, completion_tokens = self._get_response(messages)
+        self.total_prompt_tokens += prompt_tokens
+        self.total_completion_tokens += completion_tokens
+        return output
 
+    def batch_compare(self, requests: List[Tuple[str, List]]) -> List[str]:
+        # Rank several independent windows, given as (query, docs) pairs. API requests are issued concurrently
+        # with num_workers threads.
+        if self.num_workers <= 1 or len(requests) <= 1:
+            return [self.compare(query, docs) for query, docs in requests]
+        self.total_compare += len(requests)
+        messages = [create_permutation_instruction_chat(query, docs, self.llm) for query, docs in requests]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            responses = list(executor.map(self._get_response, messages))
+        outputs = []
+        for output, prompt_tokens, completion_tokens in responses:
+            self.total_prompt_tokens += prompt_tokens
+            self.total_completion_tokens += completion_tokens
+            outputs.append(output)
+        return outputs
+
+    def _sliding_steps(self, order: List[int]):
+        # Generator version of the sliding window pass over a list of indices. Each yield is a list of windows
+        # (lists of indices) and expects the list of model outputs back.
         for _ in range(self.num_repeat):
-            ranking = copy.deepcopy(ranking)
-            end_pos = len(ranking)
+            end_pos = len(order)
             start_pos = end_pos - self.window_size
             while start_pos >= 0:
                 start_pos = max(start_pos, 0)
-                result = self.compare(query, ranking[start_pos: end_pos])
-                ranking = receive_permutation(ranking, result, start_pos, end_pos)
+                result, = yield [order[start_pos: end_pos]]
+                receive_permutation(order, result, start_pos, end_pos)
                 end_pos = end_pos - self.step_size
                 start_pos = start_pos - self.step_size
+        return order
+
+    def _tournament_steps(self, order: List[int]):
+        # Partition the candidates into windows that are ranked independently (so they are yielded together),
+        # promote the top window_size - step_size of every window to the next round and repeat until the survivors
+        # fit in one final window. Takes O(log n) rounds instead of O(n / step_size) sequential window calls.
+        promote = max(self.window_size - self.step_size, 1)
+        candidates = order
+        eliminated = []
+        while len(candidates) > self.window_size:
+            windows = [candidates[i: i + self.window_size] for i in range(0, len(candidates), self.window_size)]
+            results = yield windows
+            candidates = []
+            dropped = []
+            for window, result in zip(windows, results):
+                window = receive_permutation(window, result, 0, len(window))
+                candidates.extend(window[:promote])
+                dropped.append(window[promote:])
+            # docs dropped in the same round are interleaved by their rank within their window
+            eliminated.append([window[i] for i in range(self.window_size) for window in dropped if i < len(window)])
+        if len(candidates) > 1:
+            result, = yield [candidates]
+            candidates = receive_permutation(candidates, result, 0, len(candidates))
+        for dropped in reversed(eliminated):
+            candidates.extend(dropped)
+        return candidates
+
+    def batch_rerank(self, batch: List[Tuple[str, List[SearchResult]]]) -> List[List[SearchResult]]:
+        """
+        Rerank several queries at once. Windows reorder a list of indices into each ranking and the passes of all
+        queries are advanced in lockstep: the pending windows of every query are sent to batch_compare together,
+        so the sequential dependency is only within a query. Counters are accumulated over the whole batch.
+        """
+        self.total_compare = 0
+        self.total_prompt_tokens = 0
+        self.total_completion_tokens = 0
 
-        for i, doc in enumerate(ranking):
-            doc.score = -i
-        return ranking
+        self.phase = self.method + '-window'
+        if self.method == 'tournament' and self.num_repeat > 1:
+            raise ValueError('num_repeat > 1 is only supported by the sliding method, not by tournament.')
+        if self.method == 'tournament':
+            steps = [self._tournament_steps(list(range(len(ranking)))) for _, ranking in batch]
+        elif self.method == 'sliding':
+            steps = [self._sliding_steps(list(range(len(ranking)))) for _, ranking in batch]
+        else:
+            raise NotImplementedError(f'Method {self.method} is not implemented.')
+
+        orders = [None] * len(batch)
+        pending = {}
+
+        def advance(qi, results):
+            try:
+                pending[qi] = steps[qi].send(results)
+            except StopIteration as e:
+                orders[qi] = e.value
+                pending.pop(qi, None)
+
+        for qi in range(len(batch)):
+            advance(qi, None)
+        while pending:
+            requests = []
+            for qi, windows in pending.items():
+                query, ranking = batch[qi]
+                requests.extend((query, [ranking[j] for j in window]) for window in windows)
+            outputs = self.batch_compare(requests)
+            offset = 0
+            for qi, windows in list(pending.items()):
+                advance(qi, outputs[offset: offset + len(windows)])
+                offset += len(windows)
+
+        # The SearchResults are only touched here, where they are shallow copied so that the caller's rankings are
+        # left unchanged.
+        results = []
+        for (_, ranking), order in zip(batch, orders):
+            reranked = []
+            for i, j in enumerate(order):
+                doc = copy.copy(ranking[j])
+                doc.score = -i
+                reranked.append(doc)
+            results.append(reranked)
+        return results
+
+    def rerank(self,  query: str, ranking: List[SearchResult]) -> List[SearchResult]:
+        return self.batch_rerank([(query, ranking)])[0]
 
     def truncate(self, text, length):
         return self.tokenizer.decode(self.tokenizer.encode(text)[:length])
@@ -205,13 +337,15 @@ class ListwiseLlmRanker(OpenAiListwiseLlmRanker):
                   "W"]  # "Passage X" and "Passage Y" will be tokenized into 3 tokens, so we dont use for now
 
     def __init__(self, model_name_or_path, tokenizer_name_or_path, device, window_size, step_size,
-                 scoring='generation', num_repeat=1, cache_dir=None):
+                 scoring='generation', num_repeat=1, cache_dir=None, method='sliding', encoder_cache_size=0,
+                 cpu_precision='fp32', torch_compile=False):
 
         self.scoring = scoring
         self.device = device
         self.window_size = window_size
         self.step_size = step_size
         self.num_repeat = num_repeat
+        self.method = method
         self.config = AutoConfig.from_pretrained(model_name_or_path, cache_dir=cache_dir)
 
         if self.config.model_type == 't5':
@@ -220,9 +354,9 @@ class ListwiseLlmRanker(OpenAiListwiseLlmRanker):
                                                          model_name_or_path, cache_dir=cache_dir)
             self.llm = T5ForConditionalGeneration.from_pretrained(model_name_or_path,
                                                                   device_map='auto',
-                                                                  torch_dtype=torch.float16 if device == 'cuda'
-                                                                  else torch.float32,
+                                                                  torch_dtype=model_dtype(device, cpu_precision),
                                                                   cache_dir=cache_dir)
+            self.llm = optimize_model(self.llm, device, cpu_precision, torch_compile)
 
             self.decoder_input_ids = self.tokenizer.encode("<pad> Passage",
                                                            return_tensors="pt",
@@ -232,6 +366,8 @@ class ListwiseLlmRanker(OpenAiListwiseLlmRanker):
                                                                      return_tensors="pt",
                                                                      add_special_tokens=False,
                                                                      padding=True).input_ids[:, -1]
+            if encoder_cache_size > 0:
+                self.encoder_cache = EncoderCache(self.llm, encoder_cache_size)
         elif self.config.model_type == 'llama':
             self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, cache_dir=cache_dir)
             self.tokenizer.use_default_system_prompt = False
@@ -240,9 +376,9 @@ class ListwiseLlmRanker(OpenAiListwiseLlmRanker):
 
             self.llm = AutoModelForCausalLM.from_pretrained(model_name_or_path,
                                                             device_map='auto',
-                                                            torch_dtype=torch.float16 if device == 'cuda'
-                                                            else torch.float32,
+                                                            torch_dtype=model_dtype(device, cpu_precision),
                                                             cache_dir=cache_dir).eval()
+            self.llm = optimize_model(self.llm, device, cpu_precision, torch_compile)
         else:
             raise NotImplementedError(f"Model type {self.config.model_type} is not supported yet for listwise :(")
 
@@ -254,7 +390,7 @@ class ListwiseLlmRanker(OpenAiListwiseLlmRanker):
                 input_ids = self.tokenizer(input_text, return_tensors="pt", truncation=True).input_ids.to(self.device)
                 self.total_prompt_tokens += input_ids.shape[1]
 
-                output_ids = self.llm.generate(input_ids)[0]
+                output_ids = self.llm.generate(**self._encoder_inputs(input_ids))[0]
                 self.total_completion_tokens += output_ids.shape[0]
                 output = self.tokenizer.decode(output_ids,
                                                skip_special_tokens=True).strip()
@@ -279,7 +415,8 @@ class ListwiseLlmRanker(OpenAiListwiseLlmRanker):
             self.total_prompt_tokens += input_ids.shape[1]
 
             with torch.no_grad():
-                logits = self.llm(input_ids=input_ids, decoder_input_ids=self.decoder_input_ids).logits[0][-1]
+                logits = self.llm(**self._encoder_inputs(input_ids),
+                                  decoder_input_ids=self.decoder_input_ids).logits[0][-1]
                 distributions = torch.softmax(logits, dim=0)
                 scores = distributions[self.target_token_ids[:len(docs)]]
                 ranked = sorted(zip([f"[{str(i+1)}]" for i in range(len(docs))], scores), key=lambda x: x[1], reverse=True)
@@ -287,5 +424,120 @@ class ListwiseLlmRanker(OpenAiListwiseLlmRanker):
 
         return output
 
+    def batch_compare(self, requests: List[Tuple[str, List]]) -> List[str]:
+        # Independent windows are ranked in one padded forward pass: right padding for t5, left padding for llama
+        # so that generation continues every row from its last prompt token.
+        if len(requests) <= 1 or (self.config.model_type == 'llama' and self.scoring != 'generation'):
+            return [self.compare(query, docs) for query, docs in requests]
+
+        self.total_compare += len(requests)
+        if self.config.model_type == 'llama':
+            prompts = [self.tokenizer.apply_chat_template(create_permutation_instruction_chat(query, docs,
+                                                                                              model_name=None),
+                                                          tokenize=False, add_generation_prompt=True)
+                       for query, docs in requests]
+            padding_side = self.tokenizer.padding_side
+            self.tokenizer.padding_side = 'left'
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            # the chat template already holds the special tokens, as in compare
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True,
+                                    add_special_tokens=False).to(self.device)
+            self.tokenizer.padding_side = padding_side
+            self.total_prompt_tokens += int(inputs.attention_mask.sum())
+
+            output_ids = self.llm.generate(**inputs, pad_token_id=self.tokenizer.pad_token_id)
+            new_ids = output_ids[:, inputs.input_ids.shape[1]:]
+            # same as compare, which counts the returned sequence (prompt included) as completion tokens
+            self.total_completion_tokens += int(inputs.attention_mask.sum()) + \
+                int((new_ids != self.tokenizer.pad_token_id).sum())
+            return [output.strip() for output in self.tokenizer.batch_decode(new_ids, skip_special_tokens=True)]
+
+        if self.scoring == 'generation':
+            input_texts = [create_permutation_instruction_complete(query, docs) for query, docs in requests]
+            inputs = self.tokenizer(input_texts, return_tensors="pt", padding=True, truncation=True).to(self.device)
+            self.total_prompt_tokens += int(inputs.attention_mask.sum())
+
+            output_ids = self.llm.generate(**self._encoder_inputs(inputs.input_ids, inputs.attention_mask))
+            self.total_completion_tokens += int((output_ids != self.tokenizer.pad_token_id).sum())
+            return [output.strip() for output in self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)]
+
+        elif self.scoring == 'likelihood':
+            input_texts = []
+            for query, docs in requests:
+                passages = "\n\n".join([f'Passage {self.CHARACTERS[i]}: "{doc.text}"' for i, doc in enumerate(docs)])
+                input_texts.append(f'Given a query "{query}", which of the following passages is the most relevant one to the query?\n\n'
+                                   + passages + '\n\nOutput only the passage label of the most relevant passage:')
+            inputs = self.tokenizer(input_texts, return_tensors="pt", padding=True).to(self.device)
+            self.total_prompt_tokens += int(inputs.attention_mask.sum())
+
+            outputs = []
+            with torch.no_grad():
+                logits = self.llm(**self._encoder_inputs(inputs.input_ids, inputs.attention_mask),
+                                  decoder_input_ids=self.decoder_input_ids.repeat(len(requests), 1)).logits[:, -1]
+                distributions = torch.softmax(logits, dim=1)
+                for distribution, (_, docs) in zip(distributions, requests):
+                    scores = distribution[self.target_token_ids[:len(docs)]]
+                    ranked = sorted(zip([f"[{str(i+1)}]" for i in range(len(docs))], scores), key=lambda x: x[1], reverse=True)
+                    outputs.append('>'.join(ranked[i][0] for i in range(len(ranked))))
+            return outputs
+
+    def truncate(self, text, length):
+        return self.tokenizer.convert_tokens_to_string(self.tokenizer.tokenize(text)[:length])
+
+class BackendListwiseLlmRanker(OpenAiListwiseLlmRanker):
+    """Listwise ranking on any llmrankers.backends.Backend (HF, vLLM, OpenAI-compatible server or the CPU stub)."""
+    CHARACTERS = ListwiseLlmRanker.CHARACTERS
+
+    def __init__(self, backend, window_size, step_size, scoring='generation', num_repeat=1, method='sliding'):
+        self.backend = backend
+        self.tokenizer = backend.tokenizer
+        self.scoring = scoring
+        self.window_size = window_size
+        self.step_size = step_size
+        self.num_repeat = num_repeat
+        self.method = method
+        self.total_compare = 0
+        self.total_prompt_tokens = 0
+        self.total_completion_tokens = 0
+
+    def compare(self, query: str, docs: List):
+        return self.batch_compare([(query, docs)])[0]
+
+    def batch_compare(self, requests: List[Tuple[str, List]]) -> List[str]:
+        # All windows go to the backend in one batch.
+        self.total_compare += len(requests)
+        if self.scoring == 'generation':
+            if self.backend.is_chat:
+                prompts = [create_permutation_instruction_chat(query, docs, model_name=None) for query, docs in requests]
+            else:
+                prompts = [create_permutation_instruction_complete(query, docs) for query, docs in requests]
+            # about five tokens per "[i] > " identifier
+            max_new_tokens = 6 * max(len(docs) for _, docs in requests)
+            outputs = []
+            for generation in self.backend.batch_generate(prompts, max_new_tokens=max_new_tokens):
+                self.total_prompt_tokens += generation.prompt_tokens
+                self.total_completion_tokens += generation.completion_tokens
+                outputs.append(generation.text.strip())
+            return outputs
+
+        elif self.scoring == 'likelihood':
+            input_texts = []
+            for query, docs in requests:
+                passages = "\n\n".join([f'Passage {self.CHARACTERS[i]}: "{doc.text}"' for i, doc in enumerate(docs)])
+                input_texts.append(f'Given a query "{query}", which of the following passages is the most relevant one to the query?\n\n'
+                                   + passages + '\n\nOutput only the passage label of the most relevant passage:')
+            label_scores = self.backend.batch_score_labels(input_texts,
+                                                           [self.CHARACTERS[:len(docs)] for _, docs in requests],
+                                                           prefix="Passage")
+            outputs = []
+            for result in label_scores:
+                self.total_prompt_tokens += result.prompt_tokens
+                ranked = sorted(range(len(result.scores)), key=result.scores.__getitem__, reverse=True)
+                outputs.append('>'.join(f"[{i + 1}]" for i in ranked))
+            return outputs
+
+        raise NotImplementedError(f'Scoring method {self.scoring} is not implemented.')
+
     def truncate(self, text, length):
-        return self.tokenizer.convert_tokens_to_string(self.tokenizer.tokenize(text)[:length])
\ No newline at end of file
+        return self.backend.truncate(text, length)
@@ -0,0 +1,16 @@
+import math
+from typing import Dict, List
+
+
+def ndcg(ranking, qrels: Dict[str, int], k=10):
+    # trec_eval style nDCG@k with the relevance label as gain
+    dcg = sum(qrels.get(doc.docid, 0) / math.log2(rank + 2) for rank, doc in enumerate(ranking[:k]))
+    ideal = sorted((rel for rel in qrels.values() if rel > 0), reverse=True)[:k]
+    idcg = sum(rel / math.log2(rank + 2) for rank, rel in enumerate(ideal))
+    return dcg / idcg if idcg > 0 else 0.0
+
+
+def mean_ndcg(results: List, qrels_map: Dict[str, Dict[str, int]], k=10):
+    # Averaged over the queries that have judgements; None when no qrels are available.
+    scores = [ndcg(ranking, qrels_map[qid], k) for qid, _, ranking in results if qrels_map.get(qid)]
+    return sum(scores) / len(scores) if scores else None
@@ -1,13 +1,17 @@
-from typing import List
+from typing import List, Tuple
 from .rankers import LlmRanker, SearchResult
+from .encoder_cache import EncoderCache
+from .constrained import LabelLogitsProcessor, label_logit_bias
+from .cpu import model_dtype, optimize_model
 from itertools import combinations
 from collections import defaultdict
 from tqdm import tqdm
 import copy
+import numpy as np
 import torch
 from transformers import T5Tokenizer, T5ForConditionalGeneration, AutoConfig, AutoTokenizer, AutoModelForCausalLM
 from torch.utils.data import Dataset, DataLoader
-from transformers import DataCollatorWithPadding
+from transformers import DataCollatorWithPadding, LogitsProcessorList
 import tiktoken
 import openai
 import time
@@ -26,19 +30,61 @@ class Text2TextGenerationDataset(Dataset):
                 'attention_mask': self.data['attention_mask'][item]}
 
 
+def fit_bradley_terry(wins: np.ndarray, log_strength: np.ndarray = None, iterations: int = 20):
+    """
+    Bradley-Terry log-strengths from a win matrix (wins[i, j]: wins of i over j, ties count 0.5 each way) with
+    vectorized MM updates (Hunter, 2004), warm-started from log_strength. Every doc also plays one virtual win and
+    one virtual loss against a reference of strength 1, which keeps strengths finite and anchors the scale.
+    Returns (log_strength, std) where std is the standard error of every log-strength.
+    """
+    games = wins + wins.T
+    total_wins = wins.sum(axis=1) + 1.0
+    strength = np.exp(log_strength) if log_strength is not None else np.ones(len(wins))
+    for _ in range(iterations):
+        denominator = (games / (strength[:, None] + strength[None, :])).sum(axis=1) + 2.0 / (strength + 1.0)
+        strength = total_wins / denominator
+    pair = strength[:, None] * strength[None, :] / (strength[:, None] + strength[None, :]) ** 2
+    information = (games * pair).sum(axis=1) + 2.0 * strength / (strength + 1.0) ** 2
+    return np.log(strength), 1.0 / np.sqrt(information)
+
+
 class PairwiseLlmRanker(LlmRanker):
+    # bradley_terry method: stop when the top-k has been the same for `patience` rounds, or after max_pairs
+    # compared pairs (default: as many as allpair).
+    patience = 5
+    max_pairs = None
+    num_pairs = 0  # pairs compared by the last bradley_terry rerank
+    # heapsort: in heapify, compare both children with the parent and with each other in one step instead of two
+    # sequential steps; costs one extra pair per such step, gives the same ranking.
+    speculative = False
+    forward_labels = False  # one forward pass and an argmax over the "A" / "B" label tokens instead of generate
+    constrained = False  # mask the logits so that generate can only answer "Passage A" or "Passage B"
+
     def __init__(self, model_name_or_path,
                  tokenizer_name_or_path,
                  device,
                  method="allpair",
                  batch_size=2,
                  k=10,
-                 cache_dir=None
+                 cache_dir=None,
+                 patience=5,
+                 max_pairs=None,
+                 speculative=False,
+                 encoder_cache_size=0,
+                 forward_labels=False,
+                 constrained=False,
+                 cpu_precision='fp32',
+                 torch_compile=False
                  ):
         self.device = device
         self.method = method
         self.batch_size = batch_size
         self.k = k
+        self.patience = patience
+        self.max_pairs = max_pairs
+        self.speculative = speculative
+        self.forward_labels = forward_labels
+        self.constrained = constrained
         self.prompt = """Given a query "{query}", which of the following two passages is more relevant to the query?
 
 Passage A: "{doc1}"
@@ -54,13 +100,17 @@ Output Passage A or Passage B:"""
                                                          model_name_or_path, cache_dir=cache_dir)
             self.llm = T5ForConditionalGeneration.from_pretrained(model_name_or_path,
                                                                   device_map='auto',
-                                                                  torch_dtype=torch.float16 if device == 'cuda'
-                                                                  else torch.float32,
+                                                                  torch_dtype=model_dtype(device, cpu_precision),
                                                                   cache_dir=cache_dir)
+            self.llm = optimize_model(self.llm, device, cpu_precision, torch_compile)
             self.decoder_input_ids = self.tokenizer.encode("<pad> Passage",
                                                            return_tensors="pt",
                                                            add_special_tokens=False).to(self.llm.device)
             self.decoder_input_ids = self.decoder_input_ids.repeat(self.batch_size, 1)
+            self.label_token_ids = [self.tokenizer.encode(f"<pad> Passage {label}", add_special_tokens=False)[-1]
+                                    for label in ["A", "B"]]
+            if encoder_cache_size > 0:
+                self.encoder_cache = EncoderCache(self.llm, encoder_cache_size)
         elif self.config.model_type == 'llama':
             self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, cache_dir=cache_dir)
             self.tokenizer.use_default_system_prompt = False
@@ -71,9 +121,11 @@ Output Passage A or Passage B:"""
             self.tokenizer.padding_side = "left"
             self.llm = AutoModelForCausalLM.from_pretrained(model_name_or_path,
                                                             device_map='auto',
-                                                            torch_dtype=torch.float16 if device == 'cuda'
-                                                            else torch.float32,
+                                                            torch_dtype=model_dtype(device, cpu_precision),
                                                             cache_dir=cache_dir).eval()
+            self.llm = optimize_model(self.llm, device, cpu_precision, torch_compile)
+            self.label_token_ids = [self.tokenizer.encode(f"Passage: {label}", add_special_tokens=False)[-1]
+                                    for label in ["A", "B"]]
         else:
             raise NotImplementedError(f"Model type {self.config.model_type} is not supported yet for pairwise :(")
 
@@ -88,15 +140,21 @@ Output Passage A or Passage B:"""
                        self.prompt.format(query=query, doc1=doc2, doc2=doc1)]
         output = None
         if self.config.model_type == 't5':
-            input_ids = self.tokenizer(input_texts,
-                                       padding='longest',
-                                       return_tensors="pt").input_ids.to(self.llm.device)
+            inputs = self.tokenizer(input_texts,
+                                    padding='longest',
+                                    return_tensors="pt").to(self.llm.device)
+            input_ids = inputs.input_ids
 
             self.total_prompt_tokens += input_ids.shape[0] * input_ids.shape[1]
 
-            output_ids = self.llm.generate(input_ids,
+            if self.forward_labels:
+                self.total_completion_tokens += 2
+                return self._forward_labels(self._encoder_inputs(input_ids, inputs.attention_mask), 2)
+
+            output_ids = self.llm.generate(**self._encoder_inputs(input_ids, inputs.attention_mask),
                                            decoder_input_ids=self.decoder_input_ids,
-                                           max_new_tokens=2)
+                                           max_new_tokens=2,
+                                           logits_processor=self._label_processor(self.decoder_input_ids.shape[1]))
 
             self.total_completion_tokens += output_ids.shape[0] * output_ids.shape[1]
 
@@ -111,6 +169,12 @@ Output Passage A or Passage B:"""
             prompt1 = self.tokenizer.apply_chat_template(conversation1, tokenize=False, add_generation_prompt=True)
             prompt1 += " Passage:"
 
+            if self.forward_labels:
+                inputs = self.tokenizer([prompt0, prompt1], padding=True, return_tensors="pt").to(self.device)
+                self.total_prompt_tokens += inputs.input_ids.shape[0] * inputs.input_ids.shape[1]
+                self.total_completion_tokens += 2
+                return self._forward_labels({'input_ids': inputs.input_ids, 'attention_mask': inputs.attention_mask}, 2)
+
             input_ids = self.tokenizer([prompt0, prompt1], return_tensors="pt").input_ids.to(self.device)
             self.total_prompt_tokens += input_ids.shape[0] * input_ids.shape[1]
 
@@ -118,7 +182,8 @@ Output Passage A or Passage B:"""
                                            do_sample=False,
                                            temperature=0.0,
                                            top_p=None,
-                                           max_new_tokens=1)
+                                           max_new_tokens=1,
+                                           logits_processor=self._label_processor(input_ids.shape[1]))
 
             self.total_completion_tokens += output_ids.shape[0] * output_ids.shape[1]
 
@@ -130,112 +195,339 @@ Output Passage A or Passage B:"""
 
         return output
 
-    def heapify(self, arr, n, i):
-        # Find largest among root and children
-        largest = i
-        l = 2 * i + 1
-        r = 2 * i + 2
-        if l < n and arr[l] > arr[i]:
-            largest = l
+    def batch_compare(self, requests: List[Tuple[str, List[str]]]) -> List[List[str]]:
+        # Compare several (query, [doc1, doc2]) pairs, each in both orders, in one padded forward pass.
+        if len(requests) <= 1:
+            return [self.compare(query, docs) for query, docs in requests]
+        self.total_compare += len(requests)
+        input_texts = []
+        for query, (doc1, doc2) in requests:
+            input_texts.append(self.prompt.format(query=query, doc1=doc1, doc2=doc2))
+            input_texts.append(self.prompt.format(query=query, doc1=doc2, doc2=doc1))
+
+        if self.config.model_type == 't5':
+            inputs = self.tokenizer(input_texts, padding='longest', return_tensors="pt").to(self.llm.device)
+            self.total_prompt_tokens += inputs.input_ids.shape[0] * inputs.input_ids.shape[1]
+            if self.forward_labels:
+                outputs = self._forward_labels(self._encoder_inputs(inputs.input_ids, inputs.attention_mask),
+                                               len(input_texts))
+                self.total_completion_tokens += len(input_texts)
+                return [outputs[i: i + 2] for i in range(0, len(outputs), 2)]
+            output_ids = self.llm.generate(**self._encoder_inputs(inputs.input_ids, inputs.attention_mask),
+                                           decoder_input_ids=self.decoder_input_ids[:1].repeat(len(input_texts), 1),
+                                           max_new_tokens=2,
+                                           logits_processor=self._label_processor(self.decoder_input_ids.shape[1]))
+            self.total_completion_tokens += output_ids.shape[0] * output_ids.shape[1]
+            outputs = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+        elif self.config.model_type == 'llama':
+            prompts = [self.tokenizer.apply_chat_template([{"role": "user", "content": input_text}], tokenize=False,
+                                                          add_generation_prompt=True) + " Passage:"
+                       for input_text in input_texts]
+            inputs = self.tokenizer(prompts, padding=True, return_tensors="pt").to(self.device)
+            self.total_prompt_tokens += inputs.input_ids.shape[0] * inputs.input_ids.shape[1]
+            if self.forward_labels:
+                outputs = self._forward_labels({'input_ids': inputs.input_ids, 'attention_mask': inputs.attention_mask},
+                                               len(input_texts))
+                self.total_completion_tokens += len(input_texts)
+                return [outputs[i: i + 2] for i in range(0, len(outputs), 2)]
+            output_ids = self.llm.generate(**inputs,
+                                           do_sample=False,
+                                           temperature=0.0,
+                                           top_p=None,
+                                           max_new_tokens=1,
+                                           logits_processor=self._label_processor(inputs.input_ids.shape[1]))
+            self.total_completion_tokens += output_ids.shape[0] * output_ids.shape[1]
+            outputs = [f'Passage {self.tokenizer.decode(ids[inputs.input_ids.shape[1]:], skip_special_tokens=True).strip().upper()}'
+                       for ids in output_ids]
+        else:
+            raise NotImplementedError(f"Model type {self.config.model_type} is not supported yet for pairwise :(")
+
+        return [outputs[i: i + 2] for i in range(0, len(outputs), 2)]
 
-        if r < n and arr[r] > arr[largest]:
-            largest = r
+    def _label_processor(self, start: int):
+        # logits_processor for generate: with constrained decoding, the answer can only be "A" or "B"
+        if not self.constrained:
+            return None
+        return LogitsProcessorList([LabelLogitsProcessor([self.label_token_ids], start, self.tokenizer.eos_token_id)])
 
-        # If root is not largest, swap with largest and continue heapifying
-        if largest != i:
+    def _forward_labels(self, inputs: dict, num: int) -> List[str]:
+        # Greedy decoding restricted to "Passage A" / "Passage B" in one forward pass: the argmax of the next token
+        # logits over the two label tokens, for num prompts (left-padded for causal models).
+        with torch.no_grad():
+            if self.config.model_type == 't5':
+                logits = self.llm(**inputs, decoder_input_ids=self.decoder_input_ids[:1].repeat(num, 1)).logits[:, -1]
+            else:
+                logits = self.llm(**inputs).logits[:, -1]
+        return [f'Passage {"AB"[index]}' for index in torch.argmax(logits[:, self.label_token_ids], dim=1).tolist()]
+
+    @staticmethod
+    def _greater(output) -> bool:
+        # compare(query, [a, b]) says a > b only if both orders agree
+        return output[0] == "Passage A" and output[1] == "Passage B"
+
+    def _heapify_steps(self, arr, n, i):
+        # Sift-down of node i in a max heap of the first n docs. Yields the (a, b) pairs to compare ("is a > b?")
+        # and receives the outputs back. With speculative, the left child vs root, right child vs root and right vs
+        # left child are yielded together and the two answers the sequential sift-down needs are picked from them.
+        while 2 * i + 1 < n:
+            l, r = 2 * i + 1, 2 * i + 2
+            if r < n and self.speculative:
+                outputs = yield [(arr[l], arr[i]), (arr[r], arr[i]), (arr[r], arr[l])]
+                largest = l if self._greater(outputs[0]) else i
+                if self._greater(outputs[2] if largest == l else outputs[1]):
+                    largest = r
+            else:
+                outputs = yield [(arr[l], arr[i])]
+                largest = l if self._greater(outputs[0]) else i
+                if r < n:
+                    outputs = yield [(arr[r], arr[largest])]
+                    if self._greater(outputs[0]):
+                        largest = r
+            if largest == i:
+                break
             arr[i], arr[largest] = arr[largest], arr[i]
-            self.heapify(arr, n, largest)
+            i = largest
+
+    @staticmethod
+    def _run_together(steps):
+        # Advance several comparison generators in lockstep: yield all their pending pairs at once and send each
+        # generator the outputs of its own pairs.
+        pending = []
+        for step in steps:
+            pairs = next(step, None)
+            if pairs is not None:
+                pending.append((step, pairs))
+        while pending:
+            outputs = yield [pair for _, pairs in pending for pair in pairs]
+            next_pending = []
+            offset = 0
+            for step, pairs in pending:
+                try:
+                    next_pending.append((step, step.send(outputs[offset: offset + len(pairs)])))
+                except StopIteration:
+                    pass
+                offset += len(pairs)
+            pending = next_pending
 
-    def heapSort(self, arr, k):
+    def _heapsort_steps(self, arr, k):
+        # Heapsort of the top k as a generator. Each yield is a list of independent pairs and expects their outputs
+        # back. Nodes on the same heap level have disjoint subtrees, so while building the heap they are heapified
+        # together; this gives exactly the same heap as heapifying one node at a time from the bottom up.
         n = len(arr)
+        levels = []
+        start, width = 0, 1
+        while start <= n // 2:
+            levels.append(range(start, min(start + width, n // 2 + 1)))
+            start += width
+            width *= 2
+        self.phase = 'build-heap'
+        for level in reversed(levels):
+            yield from self._run_together([self._heapify_steps(arr, n, i) for i in reversed(level)])
+        self.phase = 'sift-down'
         ranked = 0
-        # Build max heap
-        for i in range(n // 2, -1, -1):
-            self.heapify(arr, n, i)
         for i in range(n - 1, 0, -1):
-            # Swap
             arr[i], arr[0] = arr[0], arr[i]
             ranked += 1
             if ranked == k:
                 break
-            # Heapify root element
-            self.heapify(arr, i, 0)
+            yield from self._run_together([self._heapify_steps(arr, i, 0)])
+
+    def batch_rerank(self, batch: List[Tuple[str, List[SearchResult]]]) -> List[List[SearchResult]]:
+        """
+        Rerank several queries at once. The heapsorts of all queries are advanced in lockstep and every pending pair
+        (across queries, across the nodes of a heap level and, with speculative, across the two children of a node)
+        goes through batch_compare together. Gives the same rankings as rerank; counters are accumulated over the
+        whole batch. Methods other than heapsort rerank the queries one by one.
+        """
+        if self.method != "heapsort":
+            total_compare, total_completion_tokens, total_prompt_tokens = 0, 0, 0
+            results = []
+            for query, ranking in batch:
+                results.append(self.rerank(query, ranking))
+                total_compare += self.total_compare
+                total_completion_tokens += self.total_completion_tokens
+                total_prompt_tokens += self.total_prompt_tokens
+            self.total_compare = total_compare
+            self.total_completion_tokens = total_completion_tokens
+            self.total_prompt_tokens = total_prompt_tokens
+            return results
+
+        self.total_compare = 0
+        self.total_completion_tokens = 0
+        self.total_prompt_tokens = 0
+
+        arrs = [list(ranking) for _, ranking in batch]
+        sorts = [self._heapsort_steps(arr, self.k) for arr in arrs]
+        pending = {}
+        for qi, steps in enumerate(sorts):
+            pairs = next(steps, None)
+            if pairs is not None:
+                pending[qi] = pairs
+
+        while pending:
+            outputs = self.batch_compare([(batch[qi][0], [doc1.text, doc2.text])
+                                          for qi, pairs in pending.items() for doc1, doc2 in pairs])
+            next_pending = {}
+            offset = 0
+            for qi, pairs in pending.items():
+                try:
+                    next_pending[qi] = sorts[qi].send(outputs[offset: offset + len(pairs)])
+                except StopIteration:
+                    pass
+                offset += len(pairs)
+            pending = next_pending
+
+        return [self._top_k_results(list(reversed(arr)), ranking) for arr, (_, ranking) in zip(arrs, batch)]
+
+    def _allpair_outputs(self, allpairs: List[str]) -> List[str]:
+        # Answers ("Passage A" or "Passage B") for all allpair prompts, batch_size prompts per forward pass.
+        allpairs_dataset = Text2TextGenerationDataset(allpairs, self.tokenizer)
+
+        # no worker processes: bradley_terry calls this every round with a few pairs, where starting workers costs
+        # more than the tokenization they would take over
+        loader = DataLoader(
+            allpairs_dataset,
+            batch_size=self.batch_size,
+            collate_fn=DataCollatorWithPadding(
+                self.tokenizer,
+                max_length=512,
+                padding='longest',
+            ),
+            shuffle=False,
+            drop_last=False,
+            num_workers=0
+        )
+
+        outputs = []
+        labels = []
+        for batch_inputs in tqdm(loader):
+            self.total_compare += 1
+            self.total_prompt_tokens += batch_inputs['input_ids'].shape[0] * batch_inputs['input_ids'].shape[1]
+
+            if self.forward_labels:
+                labels.extend(self._forward_labels(
+                    self._encoder_inputs(batch_inputs['input_ids'].to(self.llm.device),
+                                         batch_inputs['attention_mask'].to(self.llm.device)),
+                    len(batch_inputs['input_ids'])))
+                self.total_completion_tokens += len(batch_inputs['input_ids'])
+                continue
+
+            batch_outputs = self.llm.generate(**self._encoder_inputs(batch_inputs['input_ids'].to(self.llm.device),
+                                                                     batch_inputs['attention_mask'].to(self.llm.device)),
+                                              decoder_input_ids=self.decoder_input_ids
+                                              if self.decoder_input_ids.shape[0] == len(batch_inputs['input_ids'])
+                                              else self.decoder_input_ids[:len(batch_inputs['input_ids']), :], # last batch might be smaller
+                                              max_new_tokens=2,
+                                              logits_processor=self._label_processor(self.decoder_input_ids.shape[1]))
+            self.total_completion_tokens += batch_outputs.shape[0] * batch_outputs.shape[1]
+            outputs.extend(batch_outputs.cpu().numpy())
+
+        if self.forward_labels:
+            return labels
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def _prefetch(self, query: str, pairs: List[Tuple[str, str]]):
+        # Bubblesort passes announce the neighbouring pairs they are about to compare; rankers that cache their
+        # comparisons (DuoT5LlmRanker) score them ahead in one batch.
+        pass
+
+    def _pair_wins(self, query: str, ranking: List[SearchResult], pairs: List[Tuple[int, int]]) -> List[float]:
+        # Compare every (i, j) pair of ranking indices in both orders, in batches; returns the wins of i over j
+        # (1, 0, or 0.5 when the two orders disagree).
+        prompts = []
+        for i, j in pairs:
+            prompts.append(self.prompt.format(query=query, doc1=ranking[i].text, doc2=ranking[j].text))
+            prompts.append(self.prompt.format(query=query, doc1=ranking[j].text, doc2=ranking[i].text))
+        outputs = self._allpair_outputs(prompts)
+        wins = []
+        for start in range(0, len(outputs), 2):
+            if outputs[start] == "Passage A" and outputs[start + 1] == "Passage B":
+                wins.append(1.0)
+            elif outputs[start] == "Passage B" and outputs[start + 1] == "Passage A":
+                wins.append(0.0)
+            else:  # conflict
+                wins.append(0.5)
+        return wins
+
+    def _bradley_terry(self, query: str, ranking: List[SearchResult]) -> List[SearchResult]:
+        # Active ranking: start from the chain of neighbours in the first-stage order, then repeatedly fit a
+        # Bradley-Terry model and compare the pairs that are most informative about the top-k. These are pairs
+        # near the top-k boundary with uncertain strengths and an uncertain outcome. Each round compares
+        # batch_size / 2 pairs, and every pair is compared at most once. Stops once the top-k order has not changed
+        # for `patience` rounds, once max_pairs pairs were compared, or when no informative pair is left.
+        n = len(ranking)
+        k = min(self.k, n)
+        max_pairs = self.max_pairs if self.max_pairs is not None else n * (n - 1) // 2
+        pairs_per_round = max(self.batch_size // 2, 1)
+        wins = np.zeros((n, n))
+        compared = np.zeros((n, n))
+
+        def play(pairs):
+            for (i, j), win in zip(pairs, self._pair_wins(query, ranking, pairs)):
+                wins[i, j] += win
+                wins[j, i] += 1.0 - win
+                compared[i, j] += 1
+                compared[j, i] += 1
+
+        first = [(i, i + 1) for i in range(n - 1)][:max_pairs]
+        play(first)  # batched by _allpair_outputs
+        num_pairs = len(first)
+        log_strength, std = fit_bradley_terry(wins)
+
+        top, stable = None, 0
+        while num_pairs < max_pairs:
+            order = np.argsort(-log_strength, kind='stable')
+            stable = stable + 1 if top is not None and np.array_equal(order[:k], top) else 0
+            top = order[:k]
+            if stable >= self.patience:
+                break
+
+            # candidate docs: the top-k and every doc whose interval reaches the boundary
+            boundary = log_strength[order[k - 1]] if k == n else \
+                (log_strength[order[k - 1]] + log_strength[order[k]]) / 2
+            candidates = np.zeros(n, dtype=bool)
+            candidates[order[:k]] = True
+            candidates |= np.abs(log_strength - boundary) <= std
+            probability = 1.0 / (1.0 + np.exp(log_strength[None, :] - log_strength[:, None]))
+            score = probability * (1.0 - probability) * (std[:, None] ** 2 + std[None, :] ** 2)
+            score[~(candidates[:, None] & candidates[None, :])] = 0.0
+            score[compared > 0] = 0.0  # the answer of a pair does not change when it is compared again
+            score[np.tril_indices(n)] = 0.0
+            best = np.argsort(-score, axis=None)[:min(pairs_per_round, max_pairs - num_pairs)]
+            pairs = [(int(i), int(j)) for i, j in zip(*np.unravel_index(best, score.shape)) if score[i, j] > 0]
+            if not pairs:
+                break
+            play(pairs)
+            num_pairs += len(pairs)
+            log_strength, std = fit_bradley_terry(wins, log_strength)
+
+        self.num_pairs = num_pairs
+        return [SearchResult(docid=ranking[i].docid, score=float(log_strength[i]), text=None)
+                for i in np.argsort(-log_strength, kind='stable')]
 
     def rerank(self, query: str, ranking: List[SearchResult]) -> List[SearchResult]:
+        if self.method == "heapsort":
+            return self.batch_rerank([(query, ranking)])[0]
         original_ranking = copy.deepcopy(ranking)
         self.total_compare = 0
         self.total_completion_tokens = 0
         self.total_prompt_tokens = 0
-        if self.method == "allpair":
-            doc_pairs = list(combinations(ranking, 2))
-            allpairs = []
-            for doc1, doc2 in tqdm(doc_pairs):
-                allpairs.append(self.prompt.format(query=query, doc1=doc1.text, doc2=doc2.text))
-                allpairs.append(self.prompt.format(query=query, doc1=doc2.text, doc2=doc1.text))
-
-            allpairs_dataset = Text2TextGenerationDataset(allpairs, self.tokenizer)
-
-            loader = DataLoader(
-                allpairs_dataset,
-                batch_size=self.batch_size,
-                collate_fn=DataCollatorWithPadding(
-                    self.tokenizer,
-                    max_length=512,
-                    padding='longest',
-                ),
-                shuffle=False,
-                drop_last=False,
-                num_workers=4
-            )
-
-            outputs = []
-            for batch_inputs in tqdm(loader):
-                self.total_compare += 1
-                self.total_prompt_tokens += batch_inputs['input_ids'].shape[0] * batch_inputs['input_ids'].shape[1]
-
-                batch_outputs = self.llm.generate(batch_inputs['input_ids'].to(self.llm.device),
-                                                  decoder_input_ids=self.decoder_input_ids
-                                                  if self.decoder_input_ids.shape[0] == len(batch_inputs['input_ids'])
-                                                  else self.decoder_input_ids[:len(batch_inputs['input_ids']), :], # last batch might be smaller
-                                                  max_new_tokens=2)
-                self.total_completion_tokens += batch_outputs.shape[0] * batch_outputs.shape[1]
-                outputs.extend(batch_outputs.cpu().numpy())
-
-            outputs = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+        if self.method == "bradley_terry":
+            self.phase = 'bradley-terry'
+            ranking = self._bradley_terry(query, ranking)
+
+        elif self.method == "allpair":
+            self.phase = 'allpair'
+            pairs = list(combinations(range(len(ranking)), 2))
             scores = defaultdict(float)
-            for i in range(0, len(outputs), 2):
-                doc1, doc2 = doc_pairs[i//2]
-                output1 = outputs[i]
-                output2 = outputs[i + 1]
-                if output1 == "Passage A" and output2 == "Passage B":
-                    scores[doc1.docid] += 1
-                elif output1 == "Passage B" and output2 == "Passage A":
-                    scores[doc2.docid] += 1
-                else:  # conflict
-                    scores[doc1.docid] += 0.5
-                    scores[doc2.docid] += 0.5
+            for (i, j), win in zip(pairs, self._pair_wins(query, ranking, pairs)):
+                scores[ranking[i].docid] += win
+                scores[ranking[j].docid] += 1.0 - win
 
             ranking = sorted([SearchResult(docid=docid, score=score, text=None) for docid, score in scores.items()],
                              key=lambda x: x.score, reverse=True)
 
-        elif self.method == "heapsort":
-            class ComparableDoc:
-                def __init__(self, docid, text, ranker):
-                    self.docid = docid
-                    self.text = text
-                    self.ranker = ranker
-
-                def __gt__(self, other):
-                    out = self.ranker.compare(query, [self.text, other.text])
-                    if out[0] == "Passage A" and out[1] == "Passage B":
-                        return True
-                    else:
-                        return False
-
-            arr = [ComparableDoc(docid=doc.docid, text=doc.text, ranker=self) for doc in ranking]
-            self.heapSort(arr, self.k)
-            ranking = [SearchResult(docid=doc.docid, score=-i, text=None) for i, doc in enumerate(reversed(arr))]
-
         ##  this is a bit slower but standard bobblesort implementation, keep here FYI
         # elif self.method == "bubblesort":
         #     k = min(k, len(ranking))
@@ -251,19 +543,21 @@ Output Passage A or Passage B:"""
         #                 ranking[current_ind - 1], ranking[current_ind] = ranking[current_ind], ranking[current_ind - 1]
         #             current_ind -= 1
         elif self.method == "bubblesort":
+            self.phase = 'bubble-pass'
             k = min(self.k, len(ranking))
 
             last_end = len(ranking) - 1
             for i in range(k):
                 current_ind = last_end
                 is_change = False
+                self._prefetch(query, [(ranking[j].text, ranking[j - 1].text) for j in range(last_end, i, -1)])
                 while True:
                     if current_ind <= i:
                         break
                     doc1 = ranking[current_ind]
                     doc2 = ranking[current_ind - 1]
                     output = self.compare(query, [doc1.text, doc2.text])
-                    if output[0] == "Passage A" and output[1] == "Passage B":
+                    if self._greater(output):
                         ranking[current_ind - 1], ranking[current_ind] = ranking[current_ind], ranking[current_ind - 1]
 
                         if not is_change:
@@ -276,80 +570,157 @@ Output Passage A or Passage B:"""
         else:
             raise NotImplementedError(f'Method {self.method} is not implemented.')
 
-        results = []
-        top_doc_ids = set()
-        rank = 1
-        for i, doc in enumerate(ranking[:self.k]):
-            top_doc_ids.add(doc.docid)
-            results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
-            rank += 1
-        for doc in original_ranking:
-            if doc.docid not in top_doc_ids:
-                results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
-                rank += 1
-        return results
+        return self._top_k_results(ranking, original_ranking)
 
     def truncate(self, text, length):
         return self.tokenizer.convert_tokens_to_string(self.tokenizer.tokenize(text)[:length])
 
 
-class DuoT5LlmRanker(PairwiseLlmRanker):
-    def compare(self, query: str, docs: List[str]) -> bool:
-        self.total_compare += 1
-        self.prompt = 'Query: {query} Document0: {doc1} Document1: {doc2} Relevant:'
-
-        inputs = [self.prompt.format(query=query, doc1=docs[0], doc2=docs[1]),
-                  self.prompt.format(query=query, doc1=docs[1], doc2=docs[0])]
-        inputs = self.tokenizer(inputs, padding=True, truncation=True, return_tensors="pt").to(self.llm.device)
-        decode_ids = torch.full((2, 1),
-                                self.llm.config.decoder_start_token_id,
-                                dtype=torch.long, device=self.llm.device)
+class BackendPairwiseLlmRanker(PairwiseLlmRanker):
+    """Pairwise ranking on any llmrankers.backends.Backend (HF, vLLM, OpenAI-compatible server or the CPU stub)."""
+    def __init__(self, backend, method="allpair", batch_size=2, k=10, patience=5, max_pairs=None,
+                 speculative=False, constrained=False):
+        self.backend = backend
+        self.tokenizer = backend.tokenizer
+        self.method = method
+        self.batch_size = batch_size
+        self.k = k
+        self.patience = patience
+        self.max_pairs = max_pairs
+        self.speculative = speculative
+        self.constrained = constrained
+        self.prompt = """Given a query "{query}", which of the following two passages is more relevant to the query?
 
-        self.total_prompt_tokens += inputs['input_ids'].shape[0] * inputs['input_ids'].shape[1]
+Passage A: "{doc1}"
 
-        with torch.no_grad():
-            logits = self.llm(input_ids=inputs['input_ids'],
-                              attention_mask=inputs['attention_mask'],
-                              decoder_input_ids=decode_ids).logits
-            # 6136 and 1176 are the indexes of the tokens false and true in T5.
-            batch_scores = logits[:, 0, [6136, 1176]]
-            batch_scores = torch.nn.functional.softmax(batch_scores, dim=1)
-            batch_probs = batch_scores[:, 1]
-        return batch_probs[0] > batch_probs[1]
+Passage B: "{doc2}"
 
-    def rerank(self, query: str, ranking: List[SearchResult]) -> List[SearchResult]:
-        original_ranking = copy.deepcopy(ranking)
+Output Passage A or Passage B:"""
         self.total_compare = 0
         self.total_completion_tokens = 0
         self.total_prompt_tokens = 0
-        if self.method == "heapsort":
-            class ComparableDoc:
-                def __init__(self, docid, text, ranker):
-                    self.docid = docid
-                    self.text = text
-                    self.ranker = ranker
-
-                def __gt__(self, other):
-                    return self.ranker.compare(query, [self.text, other.text])
-            arr = [ComparableDoc(docid=doc.docid, text=doc.text, ranker=self) for doc in ranking]
-            self.heapSort(arr, self.k)
-            ranking = [SearchResult(docid=doc.docid, score=-i, text=None) for i, doc in enumerate(reversed(arr))]
 
-        else:
-            raise NotImplementedError(f'Method {self.method} is not implemented.')
+    def _generate(self, input_texts: List[str]) -> List[str]:
+        outputs = []
+        for generation in self.backend.batch_generate(input_texts, max_new_tokens=2, prefix="Passage",
+                                                      labels=[["A", "B"]] * len(input_texts)
+                                                      if self.constrained else None):
+            self.total_prompt_tokens += generation.prompt_tokens
+            self.total_completion_tokens += generation.completion_tokens
+            output = generation.text.strip()
+            matches = re.findall(r"Passage ([A-B])", output)
+            outputs.append(f'Passage {matches[0] if matches else output.upper()}')
+        return outputs
+
+    def compare(self, query: str, docs: List):
+        self.total_compare += 1
+        doc1, doc2 = docs[0], docs[1]
+        return self._generate([self.prompt.format(query=query, doc1=doc1, doc2=doc2),
+                               self.prompt.format(query=query, doc1=doc2, doc2=doc1)])
+
+    def batch_compare(self, requests: List[Tuple[str, List[str]]]) -> List[List[str]]:
+        self.total_compare += len(requests)
+        input_texts = []
+        for query, (doc1, doc2) in requests:
+            input_texts.append(self.prompt.format(query=query, doc1=doc1, doc2=doc2))
+            input_texts.append(self.prompt.format(query=query, doc1=doc2, doc2=doc1))
+        outputs = self._generate(input_texts)
+        return [outputs[i: i + 2] for i in range(0, len(outputs), 2)]
+
+    def _allpair_outputs(self, allpairs: List[str]) -> List[str]:
+        outputs = []
+        for start in tqdm(range(0, len(allpairs), self.batch_size)):
+            self.total_compare += 1
+            outputs.extend(self._generate(allpairs[start: start + self.batch_size]))
+        return outputs
+
+    def truncate(self, text, length):
+        return self.backend.truncate(text, length)
+
 
-        results = []
-        top_doc_ids = set()
-        rank = 1
-        for i, doc in enumerate(ranking[:self.k]):
-            top_doc_ids.add(doc.docid)
-            results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
-            rank += 1
-        for doc in original_ranking:
-            if doc.docid not in top_doc_ids:
-                results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
-                rank += 1
-        return results
+class DuoT5LlmRanker(PairwiseLlmRanker):
+    """
+    duoT5 scores an ordered pair (doc1, doc2) with the probability of "true" after "Relevant:", i.e. that doc1 is
+    more relevant than doc2. Every ordered pair is scored once per rerank: the probabilities are cached, uncached
+    pairs are scored batch_size at a time, and cache hits are reported to an attached tracer. Supports heapsort,
+    bubblesort (each pass scores its neighbouring pairs in one batch first), allpair and bradley_terry; allpair and
+    bradley_terry use the soft wins (p(doc1, doc2) + 1 - p(doc2, doc1)) / 2.
+    """
+    _pair_cache = None
+
+    def _pair_probs(self, query: str, pairs: List[Tuple[str, str]]) -> List[float]:
+        self.prompt = 'Query: {query} Document0: {doc1} Document1: {doc2} Relevant:'
+        if self._pair_cache is None:
+            self._pair_cache = {}
+        keys = [(query, doc1, doc2) for doc1, doc2 in pairs]
+        missing = list(dict.fromkeys(key for key in keys if key not in self._pair_cache))
+        if self.tracer is not None:
+            self.tracer.add_cache(True, len(keys) - len(missing))
+            self.tracer.add_cache(False, len(missing))
+
+        batch_size = max(self.batch_size, 2)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start: start + batch_size]
+            self.total_compare += 1
+            inputs = [self.prompt.format(query=q, doc1=doc1, doc2=doc2) for q, doc1, doc2 in batch]
+            inputs = self.tokenizer(inputs, padding=True, truncation=True, return_tensors="pt").to(self.llm.device)
+            decode_ids = torch.full((len(batch), 1),
+                                    self.llm.config.decoder_start_token_id,
+                                    dtype=torch.long, device=self.llm.device)
+
+            self.total_prompt_tokens += inputs['input_ids'].shape[0] * inputs['input_ids'].shape[1]
+
+            with torch.no_grad():
+                logits = self.llm(**self._encoder_inputs(inputs['input_ids'], inputs['attention_mask']),
+                                  decoder_input_ids=decode_ids).logits
+                # 6136 and 1176 are the indexes of the tokens false and true in T5.
+                batch_scores = logits[:, 0, [6136, 1176]]
+                batch_scores = torch.nn.functional.softmax(batch_scores, dim=1)
+                batch_probs = batch_scores[:, 1]
+            for key, prob in zip(batch, batch_probs.tolist()):
+                self._pair_cache[key] = prob
+        return [self._pair_cache[key] for key in keys]
+
+    def compare(self, query: str, docs: List[str]) -> bool:
+        probs = self._pair_probs(query, [(docs[0], docs[1]), (docs[1], docs[0])])
+        return probs[0] > probs[1]
+
+    def batch_compare(self, requests: List[Tuple[str, List[str]]]) -> List[bool]:
+        # one query per request in batch_rerank, so group the pairs by query
+        by_query = defaultdict(list)
+        for index, (query, docs) in enumerate(requests):
+            by_query[query].append(index)
+        outputs = [False] * len(requests)
+        for query, indices in by_query.items():
+            pairs = []
+            for index in indices:
+                doc1, doc2 = requests[index][1]
+                pairs.extend([(doc1, doc2), (doc2, doc1)])
+            probs = self._pair_probs(query, pairs)
+            for n, index in enumerate(indices):
+                outputs[index] = probs[2 * n] > probs[2 * n + 1]
+        return outputs
+
+    @staticmethod
+    def _greater(output) -> bool:
+        return output
+
+    def _prefetch(self, query: str, pairs: List[Tuple[str, str]]):
+        self._pair_probs(query, [pair for doc1, doc2 in pairs for pair in [(doc1, doc2), (doc2, doc1)]])
+
+    def _pair_wins(self, query: str, ranking: List[SearchResult], pairs: List[Tuple[int, int]]) -> List[float]:
+        probs = self._pair_probs(query, [pair for i, j in pairs
+                                         for pair in [(ranking[i].text, ranking[j].text),
+                                                      (ranking[j].text, ranking[i].text)]])
+        return [(probs[n] + 1.0 - probs[n + 1]) / 2 for n in range(0, len(probs), 2)]
+
+    def rerank(self, query: str, ranking: List[SearchResult]) -> List[SearchResult]:
+        self._pair_cache = {}
+        return super().rerank(query, ranking)
+
+    def batch_rerank(self, batch: List[Tuple[str, List[SearchResult]]]) -> List[List[SearchResult]]:
+        self._pair_cache = {}
+        return super().batch_rerank(batch)
 
 
 class OpenAiPairwiseLlmRanker(PairwiseLlmRanker):
@@ -358,11 +729,20 @@ class OpenAiPairwiseLlmRanker(PairwiseLlmRanker):
                  api_key,
                  method="heapsort",
                  batch_size=2,
-                 k=10):
+                 k=10,
+                 patience=5,
+                 max_pairs=None,
+                 speculative=False,
+                 constrained=False):
         self.llm = model_name_or_path
         self.tokenizer = tiktoken.encoding_for_model(model_name_or_path)
         self.method = method
+        self.batch_size = batch_size
         self.k = k
+        self.patience = patience
+        self.max_pairs = max_pairs
+        self.speculative = speculative
+        self.constrained = constrained
         self.total_compare = 0
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
@@ -378,6 +758,9 @@ Output Passage A or Passage B:"""
         openai.api_key = api_key
 
     def _get_response(self, input_text):
+        # with constrained decoding, a logit bias lets the model answer only "A" or "B"
+        kwargs = {'logit_bias': label_logit_bias(self.tokenizer, self.CHARACTERS), 'max_tokens': 1} \
+            if self.constrained else {}
         while True:
             try:
                 response = openai.ChatCompletion.create(
@@ -387,7 +770,8 @@ Output Passage A or Passage B:"""
                         {"role": "user", "content": input_text},
                     ],
                     temperature=0.0,
-                    request_timeout=15
+                    request_timeout=15,
+                    **kwargs
                 )
                 self.total_completion_tokens += int(response['usage']['completion_tokens'])
                 self.total_prompt_tokens += int(response['usage']['prompt_tokens'])
@@ -397,7 +781,7 @@ Output Passage A or Passage B:"""
                 if matches:
                     output = matches[0][8]
                 elif output.strip() in self.CHARACTERS:
-                    pass
+                    output = output.strip()
                 else:
                     print(f"Unexpected output: {output}")
                     output = "A"
@@ -448,5 +832,17 @@ Output Passage A or Passage B:"""
 
         return [f'Passage {self._get_response(input_texts[0])}', f'Passage {self._get_response(input_texts[1])}']
 
+    def batch_compare(self, requests: List[Tuple[str, List[str]]]) -> List[List[str]]:
+        # the chat API takes one prompt per request
+        return [self.compare(query, docs) for query, docs in requests]
+
+    def _allpair_outputs(self, allpairs: List[str]) -> List[str]:
+        # One request per prompt; the two orders of a pair count as one compare, as in compare.
+        outputs = []
+        for start in range(0, len(allpairs), 2):
+            self.total_compare += 1
+            outputs.extend(f'Passage {self._get_response(input_text)}' for input_text in allpairs[start: start + 2])
+        return outputs
+
     def truncate(self, text, length):
         return self.tokenizer.decode(self.tokenizer.encode(text)[:length])
\ No newline at end of file
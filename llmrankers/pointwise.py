@@ -4,13 +4,15 @@ from transformers import T5Tokenizer, T5ForConditionalGeneration, AutoConfig
 from torch.utils.data import DataLoader
 from transformers import DataCollatorWithPadding
 from .pairwise import Text2TextGenerationDataset
+from .cpu import model_dtype, optimize_model
 import torch
 from tqdm import tqdm
 
 
 class PointwiseLlmRanker(LlmRanker):
 
-    def __init__(self, model_name_or_path, tokenizer_name_or_path, device, method="qlm", batch_size=1, cache_dir=None):
+    def __init__(self, model_name_or_path, tokenizer_name_or_path, device, method="qlm", batch_size=1, cache_dir=None,
+                 cpu_precision='fp32', torch_compile=False):
         self.tokenizer = T5Tokenizer.from_pretrained(tokenizer_name_or_path
                                                      if tokenizer_name_or_path is not None else
                                                      model_name_or_path,
@@ -19,9 +21,9 @@ class PointwiseLlmRanker(LlmRanker):
         if self.config.model_type == 't5':
             self.llm = T5ForConditionalGeneration.from_pretrained(model_name_or_path,
                                                                   device_map='auto',
-                                                                  torch_dtype=torch.float16 if device == 'cuda'
-                                                                  else torch.float32,
+                                                                  torch_dtype=model_dtype(device, cpu_precision),
                                                                   cache_dir=cache_dir)
+            self.llm = optimize_model(self.llm, device, cpu_precision, torch_compile)
         else:
             raise NotImplementedError(f"Model type {self.config.model_type} is not supported yet for pointwise :(")
 
@@ -37,6 +39,7 @@ class PointwiseLlmRanker(LlmRanker):
         self.total_compare = 0
         self.total_completion_tokens = 0
         self.total_prompt_tokens = 0
+        self.phase = 'pointwise'
 
         if self.method == "qlm":
             prompt = "Passage: {text}\nPlease write a question based on this passage."
@@ -138,6 +141,7 @@ class MonoT5LlmRanker(PointwiseLlmRanker):
         self.total_compare = 0
         self.total_completion_tokens = 0
         self.total_prompt_tokens = 0
+        self.phase = 'pointwise'
         prompt = "Query: {query} Document: {document} Relevant:"
         data = [prompt.format(query=query, document=doc.text) for doc in ranking]
         dataset = Text2TextGenerationDataset(data, self.tokenizer)
@@ -187,3 +191,41 @@ class MonoT5LlmRanker(PointwiseLlmRanker):
 
 
 
+
+
+class BackendPointwiseLlmRanker(PointwiseLlmRanker):
+    """Pointwise yes_no ranking on any llmrankers.backends.Backend."""
+    def __init__(self, backend, method="yes_no", batch_size=1):
+        if method != "yes_no":
+            raise NotImplementedError(f"Method {method} is not supported for BackendPointwiseLlmRanker, only yes_no.")
+        self.backend = backend
+        self.tokenizer = backend.tokenizer
+        self.method = method
+        self.batch_size = batch_size
+
+        self.total_compare = 0
+        self.total_completion_tokens = 0
+        self.total_prompt_tokens = 0
+
+    def rerank(self, query: str, ranking: List[SearchResult]) -> List[SearchResult]:
+        self.total_compare = 0
+        self.total_completion_tokens = 0
+        self.total_prompt_tokens = 0
+        self.phase = 'pointwise'
+
+        prompt = "Passage: {text}\nQuery: {query}\nDoes the passage answer the query? Answer 'Yes' or 'No'"
+        data = [prompt.format(text=doc.text, query=query) for doc in ranking]
+        current_id = 0
+        for start in tqdm(range(0, len(data), self.batch_size)):
+            self.total_compare += 1
+            batch = data[start: start + self.batch_size]
+            for result in self.backend.batch_score_labels(batch, [["Yes", "No"]] * len(batch)):
+                self.total_prompt_tokens += result.prompt_tokens
+                ranking[current_id].score = torch.softmax(torch.tensor(result.scores), dim=0)[0].item()
+                current_id += 1
+
+        ranking = sorted(ranking, key=lambda x: x.score, reverse=True)
+        return ranking
+
+    def truncate(self, text, length):
+        return self.backend.truncate(text, length)
@@ -10,6 +10,35 @@ class SearchResult:
 
 
 class LlmRanker:
+    phase = None  # current algorithm phase (e.g. build-heap, sift-down), read by llmrankers.tracing
+    tracer = None  # llmrankers.tracing.Tracer set by Tracer.attach, receives the hits of the ranker's caches
+    encoder_cache = None  # llmrankers.encoder_cache.EncoderCache of a T5 ranker, if enabled
+
+    def _encoder_inputs(self, input_ids, attention_mask=None):
+        # Keyword arguments for a T5 generate / forward call: the input ids, or their cached encoder outputs.
+        if self.encoder_cache is not None:
+            return self.encoder_cache(input_ids, attention_mask, tracer=self.tracer)
+        if attention_mask is None:
+            return {'input_ids': input_ids}
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+    def _top_k_results(self, ranking, original_ranking):
+        # Top-k of the sorted ranking followed by the remaining docs in their original order.
+        results = []
+        top_doc_ids = set()
+        rank = 1
+
+        for i, doc in enumerate(ranking[:self.k]):
+            top_doc_ids.add(doc.docid)
+            results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
+            rank += 1
+        for doc in original_ranking:
+            if doc.docid not in top_doc_ids:
+                results.append(SearchResult(docid=doc.docid, score=-rank, text=None))
+                rank += 1
+
+        return results
+
     def rerank(self,  query: str, ranking: List[SearchResult]) -> Tuple[str, List[SearchResult]]:
         raise NotImplementedError
 
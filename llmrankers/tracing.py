@@ -0,0 +1,202 @@
+import functools
+import json
+import math
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+# Ranker methods that issue model calls. Only the outermost traced call is recorded, so e.g. a compare that goes
+# through batch_compare is one event.
+TRACED_METHODS = ['compare', 'batch_compare', 'compare_batch', '_allpair_outputs', '_pair_probs', '_chat']
+TRACED_BACKEND_METHODS = ['batch_generate', 'batch_score_labels']
+
+
+def percentile(values: List[float], q: float) -> float:
+    # nearest-rank percentile
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Tracer:
+    """
+    Records one event per model call of a ranker: query id, algorithm phase (the ranker's `phase`, e.g. build-heap,
+    sift-down, bubble-pass, window), batch size, compare count, prompt / completion tokens, wall time, and the
+    tokenize / prefill / decode timings and cache hits reported by the backend during the call. Every rerank is
+    also recorded as a "rerank" event. Events are written as JSONL to `path` and summarized into per-phase latency
+    percentiles by summary().
+
+        tracer = Tracer('trace.jsonl').attach(ranker)
+        tracer.query_id = qid
+        ranker.rerank(query, ranking)
+        tracer.print_summary()
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self.events = []
+        self.query_id = None
+        self._file = open(path, 'w') if path is not None else None
+        self._depth = 0
+        self._timings = defaultdict(float)
+        self._cache = Counter()
+
+    def add_timing(self, name: str, seconds: float):
+        # Called by backends: time spent in `name` (tokenize, prefill, decode) during the current traced call.
+        self._timings[name] += seconds
+
+    def add_cache(self, hit: bool, count: int = 1):
+        # Called by caches: lookups that hit / missed during the current traced call.
+        self._cache['hits' if hit else 'misses'] += count
+
+    def record(self, event: Dict):
+        self.events.append(event)
+        if self._file is not None:
+            self._file.write(json.dumps(event) + '\n')
+
+    def _wrap(self, obj, name, ranker, batch_size_fn, tokens_fn):
+        # Replace obj.name by a traced version; events carry the ranker's current phase.
+        method = getattr(obj, name)
+
+        @functools.wraps(method)
+        def traced(*args, **kwargs):
+            if self._depth > 0:
+                return method(*args, **kwargs)
+            self._timings.clear()
+            self._cache.clear()
+            before = (ranker.total_compare, ranker.total_prompt_tokens, ranker.total_completion_tokens)
+            self._depth += 1
+            tic = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                self._depth -= 1
+            latency = time.perf_counter() - tic
+            compares, prompt_tokens, completion_tokens = tokens_fn(result, before)
+            self.record({'type': 'call',
+                         'qid': self.query_id,
+                         'ranker': type(ranker).__name__,
+                         'method': name,
+                         'phase': ranker.phase,
+                         'batch_size': batch_size_fn(name, result),
+                         'compares': compares,
+                         'prompt_tokens': prompt_tokens,
+                         'completion_tokens': completion_tokens,
+                         'latency': latency,
+                         'timings': dict(self._timings),
+                         'cache_hits': self._cache['hits'],
+                         'cache_misses': self._cache['misses']})
+            return result
+        setattr(obj, name, traced)
+
+    def attach(self, ranker, record_rerank: bool = True):
+        """Instrument a ranker (its backend, if it has one, and the stages of a cascade) in place. Returns self."""
+        for stage in getattr(ranker, 'stages', []):
+            self.attach(stage, record_rerank=False)
+
+        def counter_deltas(result, before):
+            return (ranker.total_compare - before[0], ranker.total_prompt_tokens - before[1],
+                    ranker.total_completion_tokens - before[2])
+
+        def call_batch_size(name, result):
+            # compare returns one answer (or a pair of answers for pairwise), the batched methods one per request
+            return len(result) if name != 'compare' and isinstance(result, list) else 1
+
+        ranker.tracer = self
+        for name in TRACED_METHODS:
+            if hasattr(ranker, name):
+                self._wrap(ranker, name, ranker, call_batch_size, counter_deltas)
+
+        backend = getattr(ranker, 'backend', None)
+        if backend is not None:
+            backend.tracer = self
+
+            # Backend calls made directly by the ranker (e.g. pointwise) count as one compare; tokens are read
+            # from the results.
+            def result_tokens(result, before):
+                return (1, sum(r.prompt_tokens for r in result),
+                        sum(getattr(r, 'completion_tokens', 0) for r in result))
+
+            for name in TRACED_BACKEND_METHODS:
+                self._wrap(backend, name, ranker, lambda name, result: len(result), result_tokens)
+
+        if not record_rerank:
+            return self
+        rerank = ranker.rerank
+
+        @functools.wraps(rerank)
+        def traced_rerank(*args, **kwargs):
+            tic = time.perf_counter()
+            result = rerank(*args, **kwargs)
+            self.record({'type': 'rerank',
+                         'qid': self.query_id,
+                         'ranker': type(ranker).__name__,
+                         'phase': 'rerank',
+                         'compares': ranker.total_compare,
+                         'prompt_tokens': ranker.total_prompt_tokens,
+                         'completion_tokens': ranker.total_completion_tokens,
+                         'latency': time.perf_counter() - tic})
+            return result
+        ranker.rerank = traced_rerank
+        return self
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return summarize(self.events)
+
+    def print_summary(self):
+        print_summary(self.summary())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def summarize(events: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """Per-phase latency percentiles and totals. Call events are grouped by phase; rerank events form 'rerank'."""
+    groups = defaultdict(list)
+    for event in events:
+        groups[event['phase'] if event['type'] == 'call' else 'rerank'].append(event)
+    call_time = sum(event['latency'] for event in events if event['type'] == 'call')
+    summary = {}
+    for phase, group in groups.items():
+        latencies = [event['latency'] for event in group]
+        row = {'events': len(group),
+               'compares': sum(event.get('compares', 0) for event in group),
+               'prompt_tokens': sum(event.get('prompt_tokens', 0) for event in group),
+               'completion_tokens': sum(event.get('completion_tokens', 0) for event in group),
+               'total_time': sum(latencies),
+               'time_share': sum(latencies) / call_time if phase != 'rerank' and call_time > 0 else 1.0,
+               'p50': percentile(latencies, 50),
+               'p95': percentile(latencies, 95),
+               'p99': percentile(latencies, 99)}
+        if phase != 'rerank':
+            row['avg_batch_size'] = sum(event.get('batch_size', 0) for event in group) / len(group)
+            row['cache_hits'] = sum(event.get('cache_hits', 0) for event in group)
+            row['cache_misses'] = sum(event.get('cache_misses', 0) for event in group)
+            for event in group:
+                for name, seconds in event.get('timings', {}).items():
+                    row[f'{name}_time'] = row.get(f'{name}_time', 0.0) + seconds
+        summary[str(phase)] = row
+    return summary
+
+
+def print_summary(summary: Dict[str, Dict[str, float]]):
+    columns = ['events', 'compares', 'avg_batch_size', 'prompt_tokens', 'completion_tokens', 'total_time',
+               'time_share', 'p50', 'p95', 'p99', 'tokenize_time', 'prefill_time', 'decode_time', 'cache_hits',
+               'cache_misses']
+    print('\t'.join(['phase'] + columns))
+    for phase, row in summary.items():
+        print('\t'.join([phase] + [f'{row[c]:.4f}' if isinstance(row.get(c), float) else str(row.get(c, '-'))
+                                   for c in columns]))
+
+
+def load_events(path: str) -> List[Dict]:
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+    # python -m llmrankers.tracing trace.jsonl
+    print_summary(summarize(load_events(sys.argv[1])))
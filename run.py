@@ -3,11 +3,17 @@ import ir_datasets
 from pyserini.search.lucene import LuceneSearcher
 from pyserini.search._base import get_topics
 from llmrankers.rankers import SearchResult
-from llmrankers.pointwise import PointwiseLlmRanker, MonoT5LlmRanker
-from llmrankers.setwise import SetwiseLlmRanker, OpenAiSetwiseLlmRanker
-from llmrankers.pairwise import PairwiseLlmRanker, DuoT5LlmRanker, OpenAiPairwiseLlmRanker
-from llmrankers.listwise import OpenAiListwiseLlmRanker, ListwiseLlmRanker
+from llmrankers.pointwise import PointwiseLlmRanker, MonoT5LlmRanker, BackendPointwiseLlmRanker
+from llmrankers.setwise import SetwiseLlmRanker, OpenAiSetwiseLlmRanker, BackendSetwiseLlmRanker
+from llmrankers.pairwise import PairwiseLlmRanker, DuoT5LlmRanker, OpenAiPairwiseLlmRanker, BackendPairwiseLlmRanker
+from llmrankers.listwise import OpenAiListwiseLlmRanker, ListwiseLlmRanker, BackendListwiseLlmRanker
+from llmrankers.backends import load_backend
+from llmrankers.tracing import Tracer
+from llmrankers.budget import BudgetController
+from llmrankers.cascade import CascadeLlmRanker
+from llmrankers.cpu import CPU_PRECISIONS
 from tqdm import tqdm
+import torch
 import argparse
 import sys
 import json
@@ -49,14 +55,100 @@ def write_run_file(path, results, tag):
                 rank += 1
 
 
+def load_backend_ranker(args):
+    if args.run.backend == 'openai' and args.run.scoring == 'likelihood' and (args.setwise or args.listwise):
+        raise ValueError('--scoring likelihood needs a backend that can force the "Passage" answer prefix '
+                         '(hf or vllm), use --scoring generation with --backend openai.')
+    backend = load_backend(args.run.backend,
+                           model_name_or_path=args.run.model_name_or_path,
+                           tokenizer_name_or_path=args.run.tokenizer_name_or_path,
+                           device=args.run.device,
+                           cache_dir=args.run.cache_dir,
+                           cpu_precision=args.run.cpu_precision,
+                           torch_compile=args.run.torch_compile,
+                           api_key=args.run.openai_key,
+                           base_url=args.run.base_url)
+    if args.pointwise:
+        return BackendPointwiseLlmRanker(backend,
+                                         method=args.pointwise.method,
+                                         batch_size=args.pointwise.batch_size)
+    elif args.setwise:
+        return BackendSetwiseLlmRanker(backend,
+                                       num_child=args.setwise.num_child,
+                                       k=args.setwise.k,
+                                       scoring=args.run.scoring,
+                                       method=args.setwise.method,
+                                       prior_heap=args.setwise.prior_heap,
+                                       prior_skip_margin=args.setwise.prior_skip_margin,
+                                       context_budget=args.setwise.context_budget,
+                                       constrained=args.run.constrained_decoding)
+    elif args.pairwise:
+        return BackendPairwiseLlmRanker(backend,
+                                        method=args.pairwise.method,
+                                        batch_size=args.pairwise.batch_size
+                                        if args.pairwise.method in ['allpair', 'bradley_terry'] else 2,
+                                        k=args.pairwise.k,
+                                        patience=args.pairwise.patience,
+                                        max_pairs=args.pairwise.max_pairs,
+                                        speculative=args.pairwise.speculative,
+                                        constrained=args.run.constrained_decoding)
+    elif args.listwise:
+        return BackendListwiseLlmRanker(backend,
+                                        window_size=args.listwise.window_size,
+                                        step_size=args.listwise.step_size,
+                                        scoring=args.run.scoring,
+                                        num_repeat=args.listwise.num_repeat,
+                                        method=args.listwise.method)
+    raise ValueError('Must specify either --pointwise, --setwise, --pairwise or --listwise.')
+
+
+def load_prefilter(args):
+    # The cheap first stage of a cascade: a pointwise ranker with its own model and a large batch size.
+    if args.run.backend is not None:
+        backend = load_backend(args.run.backend,
+                               model_name_or_path=args.run.prefilter_model_name_or_path,
+                               device=args.run.device,
+                               cache_dir=args.run.cache_dir,
+                               cpu_precision=args.run.cpu_precision,
+                               torch_compile=args.run.torch_compile,
+                               api_key=args.run.openai_key,
+                               base_url=args.run.base_url,
+                               batch_size=args.run.prefilter_batch_size)
+        return BackendPointwiseLlmRanker(backend,
+                                         method=args.run.prefilter_method,
+                                         batch_size=args.run.prefilter_batch_size)
+    if 'monot5' in args.run.prefilter_model_name_or_path:
+        return MonoT5LlmRanker(model_name_or_path=args.run.prefilter_model_name_or_path,
+                               tokenizer_name_or_path=None,
+                               device=args.run.device,
+                               cache_dir=args.run.cache_dir,
+                               cpu_precision=args.run.cpu_precision,
+                               torch_compile=args.run.torch_compile,
+                               method=args.run.prefilter_method,
+                               batch_size=args.run.prefilter_batch_size)
+    return PointwiseLlmRanker(model_name_or_path=args.run.prefilter_model_name_or_path,
+                              tokenizer_name_or_path=None,
+                              device=args.run.device,
+                              cache_dir=args.run.cache_dir,
+                              cpu_precision=args.run.cpu_precision,
+                              torch_compile=args.run.torch_compile,
+                              method=args.run.prefilter_method,
+                              batch_size=args.run.prefilter_batch_size)
+
+
 def main(args):
 
-    if args.pointwise:
+    if args.run.backend is not None:
+        ranker = load_backend_ranker(args)
+
+    elif args.pointwise:
         if 'monot5' in args.run.model_name_or_path:
             ranker = MonoT5LlmRanker(model_name_or_path=args.run.model_name_or_path,
                                      tokenizer_name_or_path=args.run.tokenizer_name_or_path,
                                      device=args.run.device,
                                      cache_dir=args.run.cache_dir,
+                                     cpu_precision=args.run.cpu_precision,
+                                     torch_compile=args.run.torch_compile,
                                      method=args.pointwise.method,
                                      batch_size=args.pointwise.batch_size)
         else:
@@ -64,6 +156,8 @@ def main(args):
                                         tokenizer_name_or_path=args.run.tokenizer_name_or_path,
                                         device=args.run.device,
                                         cache_dir=args.run.cache_dir,
+                                        cpu_precision=args.run.cpu_precision,
+                                        torch_compile=args.run.torch_compile,
                                         method=args.pointwise.method,
                                         batch_size=args.pointwise.batch_size)
 
@@ -73,20 +167,30 @@ def main(args):
                                             api_key=args.run.openai_key,
                                             num_child=args.setwise.num_child,
                                             method=args.setwise.method,
-                                            k=args.setwise.k)
+                                            k=args.setwise.k,
+                                            constrained=args.run.constrained_decoding)
         else:
             ranker = SetwiseLlmRanker(model_name_or_path=args.run.model_name_or_path,
                                       tokenizer_name_or_path=args.run.tokenizer_name_or_path,
                                       device=args.run.device,
                                       cache_dir=args.run.cache_dir,
+                                      cpu_precision=args.run.cpu_precision,
+                                      torch_compile=args.run.torch_compile,
                                       num_child=args.setwise.num_child,
                                       scoring=args.run.scoring,
                                       method=args.setwise.method,
                                       num_permutation=args.setwise.num_permutation,
-                                      k=args.setwise.k)
+                                      k=args.setwise.k,
+                                      prior_heap=args.setwise.prior_heap,
+                                      prior_skip_margin=args.setwise.prior_skip_margin,
+                                      context_budget=args.setwise.context_budget,
+                                      encoder_cache_size=args.run.encoder_cache_size,
+                                      forward_labels=args.run.forward_labels,
+                                      constrained=args.run.constrained_decoding)
 
     elif args.pairwise:
-        if args.pairwise.method != 'allpair':
+        # duoT5 scores single prompts, its batch_size batches them in every method
+        if args.pairwise.method not in ['allpair', 'bradley_terry'] and 'duot5' not in args.run.model_name_or_path:
             args.pairwise.batch_size = 2
             logger.info(f'Setting batch_size to 2.')
 
@@ -94,24 +198,42 @@ def main(args):
             ranker = OpenAiPairwiseLlmRanker(model_name_or_path=args.run.model_name_or_path,
                                              api_key=args.run.openai_key,
                                              method=args.pairwise.method,
-                                             k=args.pairwise.k)
+                                             k=args.pairwise.k,
+                                             patience=args.pairwise.patience,
+                                             max_pairs=args.pairwise.max_pairs,
+                                             speculative=args.pairwise.speculative,
+                                             constrained=args.run.constrained_decoding)
 
         elif 'duot5' in args.run.model_name_or_path:
             ranker = DuoT5LlmRanker(model_name_or_path=args.run.model_name_or_path,
                                     tokenizer_name_or_path=args.run.tokenizer_name_or_path,
                                     device=args.run.device,
                                     cache_dir=args.run.cache_dir,
+                                    cpu_precision=args.run.cpu_precision,
+                                    torch_compile=args.run.torch_compile,
                                     method=args.pairwise.method,
                                     batch_size=args.pairwise.batch_size,
-                                    k=args.pairwise.k)
+                                    k=args.pairwise.k,
+                                    patience=args.pairwise.patience,
+                                    max_pairs=args.pairwise.max_pairs,
+                                    speculative=args.pairwise.speculative,
+                                    encoder_cache_size=args.run.encoder_cache_size)
         else:
             ranker = PairwiseLlmRanker(model_name_or_path=args.run.model_name_or_path,
                                        tokenizer_name_or_path=args.run.tokenizer_name_or_path,
                                        device=args.run.device,
                                        cache_dir=args.run.cache_dir,
+                                       cpu_precision=args.run.cpu_precision,
+                                       torch_compile=args.run.torch_compile,
                                        method=args.pairwise.method,
                                        batch_size=args.pairwise.batch_size,
-                                       k=args.pairwise.k)
+                                       k=args.pairwise.k,
+                                       patience=args.pairwise.patience,
+                                       max_pairs=args.pairwise.max_pairs,
+                                       speculative=args.pairwise.speculative,
+                                       encoder_cache_size=args.run.encoder_cache_size,
+                                       forward_labels=args.run.forward_labels,
+                                       constrained=args.run.constrained_decoding)
 
     elif args.listwise:
         if args.run.openai_key:
@@ -119,19 +241,28 @@ def main(args):
                                              api_key=args.run.openai_key,
                                              window_size=args.listwise.window_size,
                                              step_size=args.listwise.step_size,
-                                             num_repeat=args.listwise.num_repeat)
+                                             num_repeat=args.listwise.num_repeat,
+                                             method=args.listwise.method,
+                                             num_workers=args.listwise.num_workers)
         else:
             ranker = ListwiseLlmRanker(model_name_or_path=args.run.model_name_or_path,
                                        tokenizer_name_or_path=args.run.tokenizer_name_or_path,
                                        device=args.run.device,
                                        cache_dir=args.run.cache_dir,
+                                       cpu_precision=args.run.cpu_precision,
+                                       torch_compile=args.run.torch_compile,
                                        window_size=args.listwise.window_size,
                                        step_size=args.listwise.step_size,
                                        scoring=args.run.scoring,
-                                       num_repeat=args.listwise.num_repeat)
+                                       num_repeat=args.listwise.num_repeat,
+                                       method=args.listwise.method,
+                                       encoder_cache_size=args.run.encoder_cache_size)
     else:
         raise ValueError('Must specify either --pointwise, --setwise, --pairwise or --listwise.')
 
+    if args.run.prefilter_model_name_or_path is not None:
+        ranker = CascadeLlmRanker(load_prefilter(args), ranker, top_m=args.run.prefilter_top_m)
+
     query_map = {}
     if args.run.ir_dataset_name is not None:
         dataset = ir_datasets.load(args.run.ir_dataset_name)
@@ -175,21 +306,48 @@ def main(args):
             current_ranking.append(SearchResult(docid=docid, score=float(score), text=text))
         first_stage_rankings.append((current_qid, query_map[current_qid], current_ranking[:args.run.hits]))
 
+    tracer = Tracer(args.run.trace_path).attach(ranker) if args.run.trace_path is not None else None
+    budget = None
+    if args.run.max_compare is not None or args.run.max_tokens is not None:
+        budget = BudgetController(max_compare=args.run.max_compare, max_tokens=args.run.max_tokens,
+                                  max_num_child=args.run.max_num_child, max_window_size=args.run.max_window_size)
+    total_fallbacks = 0
+    query_batch_size = args.run.query_batch_size
+    if query_batch_size > 1 and not hasattr(ranker, 'batch_rerank'):
+        logger.info(f'{type(ranker).__name__} has no batch_rerank, reranking one query at a time.')
+        query_batch_size = 1
+    if query_batch_size > 1 and budget is not None:
+        raise ValueError('--query_batch_size cannot be combined with --max_compare or --max_tokens.')
+
     reranked_results = []
     total_comparisons = 0
     total_prompt_tokens = 0
     total_completion_tokens = 0
 
     tic = time.time()
-    for qid, query, ranking in tqdm(first_stage_rankings):
-        if args.run.shuffle_ranking is not None:
-            if args.run.shuffle_ranking == 'random':
-                random.shuffle(ranking)
-            elif args.run.shuffle_ranking == 'inverse':
-                ranking = ranking[::-1]
+    for start in tqdm(range(0, len(first_stage_rankings), query_batch_size)):
+        batch = []
+        for qid, query, ranking in first_stage_rankings[start: start + query_batch_size]:
+            if args.run.shuffle_ranking is not None:
+                if args.run.shuffle_ranking == 'random':
+                    random.shuffle(ranking)
+                elif args.run.shuffle_ranking == 'inverse':
+                    ranking = ranking[::-1]
+                else:
+                    raise ValueError(f'Invalid shuffle ranking method: {args.run.shuffle_ranking}.')
+            batch.append((qid, query, ranking))
+        if tracer is not None:
+            tracer.query_id = ','.join(qid for qid, _, _ in batch)
+        if query_batch_size > 1:
+            reranked = ranker.batch_rerank([(query, ranking) for _, query, ranking in batch])
+            reranked_results.extend((qid, query, results) for (qid, query, _), results in zip(batch, reranked))
+        else:
+            qid, query, ranking = batch[0]
+            if budget is not None:
+                reranked_results.append((qid, query, budget.rerank(ranker, query, ranking)))
+                total_fallbacks += budget.fallbacks
             else:
-                raise ValueError(f'Invalid shuffle ranking method: {args.run.shuffle_ranking}.')
-        reranked_results.append((qid, query, ranker.rerank(query, ranking)))
+                reranked_results.append((qid, query, ranker.rerank(query, ranking)))
         total_comparisons += ranker.total_compare
         total_prompt_tokens += ranker.total_prompt_tokens
         total_completion_tokens += ranker.total_completion_tokens
@@ -199,6 +357,12 @@ def main(args):
     print(f'Avg prompt tokens: {total_prompt_tokens/len(reranked_results)}')
     print(f'Avg completion tokens: {total_completion_tokens/len(reranked_results)}')
     print(f'Avg time per query: {(toc-tic)/len(reranked_results)}')
+    if budget is not None:
+        print(f'Avg comparisons answered by first-stage order: {total_fallbacks/len(reranked_results)}')
+
+    if tracer is not None:
+        tracer.close()
+        tracer.print_summary()
 
     write_run_file(args.run.save_path, reranked_results, 'LLMRankers')
 
@@ -224,6 +388,50 @@ if __name__ == '__main__':
     run_parser.add_argument('--openai_key', type=str, default=None)
     run_parser.add_argument('--scoring', type=str, default='generation', choices=['generation', 'likelihood'])
     run_parser.add_argument('--shuffle_ranking', type=str, default=None, choices=['inverse', 'random'])
+    run_parser.add_argument('--backend', type=str, default=None, choices=['hf', 'vllm', 'openai', 'stub'],
+                            help='Run the ranking method on a pluggable inference backend instead of the built-in '
+                                 'model code.')
+    run_parser.add_argument('--base_url', type=str, default=None,
+                            help='Base URL of an OpenAI-compatible server for --backend openai.')
+    run_parser.add_argument('--trace_path', type=str, default=None,
+                            help='Write one JSONL event per model call (phase, batch size, tokens, timings) and '
+                                 'print per-phase p50/p95/p99 latencies.')
+    run_parser.add_argument('--prefilter_model_name_or_path', type=str, default=None,
+                            help='Cascade mode: a pointwise model (e.g. castorini/monot5-base-msmarco) scores all '
+                                 '--hits candidates and only its top --prefilter_top_m go to the chosen method.')
+    run_parser.add_argument('--prefilter_method', type=str, default='yes_no', choices=['qlm', 'yes_no'])
+    run_parser.add_argument('--prefilter_batch_size', type=int, default=32)
+    run_parser.add_argument('--prefilter_top_m', type=int, default=50)
+    run_parser.add_argument('--max_compare', type=int, default=None,
+                            help='Budget of model calls per query. Fewer candidates enter the ranker and comparisons '
+                                 'beyond the budget follow the first-stage order.')
+    run_parser.add_argument('--max_tokens', type=int, default=None,
+                            help='Budget of prompt + completion tokens per query, enforced like --max_compare.')
+    run_parser.add_argument('--max_num_child', type=int, default=None,
+                            help='Setwise: allow the budget to raise num_child up to this value.')
+    run_parser.add_argument('--max_window_size', type=int, default=None,
+                            help='Listwise: allow the budget to raise window_size (and step_size) up to this value.')
+    run_parser.add_argument('--encoder_cache_size', type=int, default=0,
+                            help='T5 models: keep the encoder outputs of this many recent inputs (LRU) and reuse them '
+                                 'for repeated inputs. 0 disables the cache.')
+    run_parser.add_argument('--forward_labels', action='store_true',
+                            help='Setwise / pairwise generation: decode the passage label with one forward pass and an '
+                                 'argmax over the label tokens instead of generate (greedy decoding restricted to '
+                                 'valid labels).')
+    run_parser.add_argument('--constrained_decoding', action='store_true',
+                            help='Setwise / pairwise generation: constrain the generated answer to the valid passage '
+                                 'labels (masked logits with HF, allowed tokens with vLLM, a logit bias or guided '
+                                 'choice with OpenAI-compatible APIs), so there are no unexpected outputs.')
+    run_parser.add_argument('--cpu_precision', type=str, default='fp32', choices=CPU_PRECISIONS,
+                            help='HF models on CPU: fp32, bf16 (fast on CPUs with native bf16 support), or int8 '
+                                 '(dynamic quantization of the Linear layers). Ignored with --device cuda.')
+    run_parser.add_argument('--num_threads', type=int, default=None,
+                            help='Number of CPU threads used by torch (torch.set_num_threads).')
+    run_parser.add_argument('--torch_compile', action='store_true',
+                            help='HF models: compile the forward pass with torch.compile.')
+    run_parser.add_argument('--query_batch_size', type=int, default=1,
+                            help='Rerank this many queries together with the ranker\'s batch_rerank (listwise, '
+                                 'pairwise heapsort, Rank-R1), batching their model calls.')
 
     pointwise_parser = commands.add_parser('pointwise')
     pointwise_parser.add_argument('--method', type=str, default='yes_no',
@@ -232,9 +440,17 @@ if __name__ == '__main__':
 
     pairwise_parser = commands.add_parser('pairwise')
     pairwise_parser.add_argument('--method', type=str, default='allpair',
-                                 choices=['allpair', 'heapsort', 'bubblesort'])
+                                 choices=['allpair', 'heapsort', 'bubblesort', 'bradley_terry'])
     pairwise_parser.add_argument('--batch_size', type=int, default=2)
     pairwise_parser.add_argument('--k', type=int, default=10)
+    pairwise_parser.add_argument('--patience', type=int, default=5,
+                                 help='bradley_terry: stop once the top-k has not changed for this many rounds of '
+                                      'batch_size / 2 pairs.')
+    pairwise_parser.add_argument('--max_pairs', type=int, default=None,
+                                 help='bradley_terry: compare at most this many pairs (default: all pairs).')
+    pairwise_parser.add_argument('--speculative', action='store_true',
+                                 help='Heapsort: compare both children with the parent and with each other in one '
+                                      'batch. Same ranking, fewer sequential steps, one extra pair per step.')
 
     setwise_parser = commands.add_parser('setwise')
     setwise_parser.add_argument('--num_child', type=int, default=3)
@@ -242,11 +458,24 @@ if __name__ == '__main__':
                                 choices=['heapsort', 'bubblesort'])
     setwise_parser.add_argument('--k', type=int, default=10)
     setwise_parser.add_argument('--num_permutation', type=int, default=1)
+    setwise_parser.add_argument('--prior_heap', action='store_true',
+                                help='Heapsort: arrange the candidates by their first-stage (or prefilter) score before '
+                                     'building the heap.')
+    setwise_parser.add_argument('--prior_skip_margin', type=float, default=None,
+                                help='Heapsort: skip comparisons that the prior score decides with this margin, in '
+                                     'standard deviations of the prior.')
+    setwise_parser.add_argument('--context_budget', type=int, default=None,
+                                help='Choose num_child per query: as many children as fit in this many prompt tokens '
+                                     '(overrides --num_child). Leave room for the chat template and the answer.')
 
     listwise_parser = commands.add_parser('listwise')
     listwise_parser.add_argument('--window_size', type=int, default=3)
     listwise_parser.add_argument('--step_size', type=int, default=1)
     listwise_parser.add_argument('--num_repeat', type=int, default=1)
+    listwise_parser.add_argument('--method', type=str, default='sliding',
+                                 choices=['sliding', 'tournament'])
+    listwise_parser.add_argument('--num_workers', type=int, default=1,
+                                 help='Number of concurrent API requests for independent windows (openai only).')
 
     args = parse_args(parser, commands)
 
@@ -256,4 +485,9 @@ if __name__ == '__main__':
     arg_dict = vars(args)
     if arg_dict['run'] is None or sum(arg_dict[arg] is not None for arg in arg_dict) != 2:
         raise ValueError('Need to set --run and can only set one of --pointwise, --pairwise, --setwise, --listwise')
-    main(args)
+
+    if args.run.num_threads is not None:
+        torch.set_num_threads(args.run.num_threads)
+    # on CPU, run without autograd bookkeeping (no version counters or views tracking) throughout
+    with torch.inference_mode(args.run.device == 'cpu'):
+        main(args)
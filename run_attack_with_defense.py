@@ -7,12 +7,15 @@ from llmrankers.pointwise import PointwiseLlmRanker, MonoT5LlmRanker
 from llmrankers.setwise_with_defense import SetwiseLlmRanker, OpenAiSetwiseLlmRanker
 from llmrankers.pairwise import PairwiseLlmRanker, DuoT5LlmRanker, OpenAiPairwiseLlmRanker
 from llmrankers.listwise import OpenAiListwiseLlmRanker, ListwiseLlmRanker
+from llmrankers.metrics import mean_ndcg
 from tqdm import tqdm
 import argparse
 import sys
 import json
 import time
 import random
+import itertools
+import os
 from collections import defaultdict
 
 random.seed(929)
@@ -51,6 +54,17 @@ def write_run_file(path, results, tag):
                 rank += 1
 
 
+def write_summary(path, summary):
+    header = ['attack_type', 'attack_position', 'defense_strategy', 'avg_comparisons', 'avg_prompt_tokens',
+              'avg_completion_tokens', 'avg_time_per_query', 'ndcg@10']
+    lines = ['\t'.join(header)]
+    for row in summary:
+        lines.append('\t'.join(f'{value:.4f}' if isinstance(value, float) else str(value) for value in row))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+
+
 def main(args):
 
     if args.pointwise:
@@ -202,33 +216,103 @@ def main(args):
 
 
 
-    reranked_results = []
-    total_comparisons = 0
-    total_prompt_tokens = 0
-    total_completion_tokens = 0
-
-    tic = time.time()
-    for qid, query, ranking in tqdm(first_stage_rankings):
-        if args.run.shuffle_ranking is not None:
+    if args.run.shuffle_ranking is not None:
+        for i, (qid, query, ranking) in enumerate(first_stage_rankings):
             if args.run.shuffle_ranking == 'random':
                 random.shuffle(ranking)
             elif args.run.shuffle_ranking == 'inverse':
                 ranking = ranking[::-1]
             else:
                 raise ValueError(f'Invalid shuffle ranking method: {args.run.shuffle_ranking}.')
-        reranked_results.append((qid, query, ranker.rerank(query, ranking, attack_prompt=args.run.attack_type, attack_position=args.run.attack_position, defense_strategy=args.run.defense_strategy)))
-        total_comparisons += ranker.total_compare
-        total_prompt_tokens += ranker.total_prompt_tokens
-        total_completion_tokens += ranker.total_completion_tokens
-    toc = time.time()
+            first_stage_rankings[i] = (qid, query, ranking)
+
+    # Every attack_type x attack_position x defense_strategy cell reuses the loaded model, docstore and rankings.
+    # Without an attack the position makes no difference, so those cells are only run once.
+    cells = []
+    for attack_type, attack_position, defense_strategy in itertools.product(args.run.attack_type,
+                                                                            args.run.attack_position,
+                                                                            args.run.defense_strategy):
+        if attack_type == 'none':
+            attack_position = args.run.attack_position[0]
+        if (attack_type, attack_position, defense_strategy) not in cells:
+            cells.append((attack_type, attack_position, defense_strategy))
+
+    if not args.run.grid and len(cells) != 1:
+        raise ValueError('Multiple attack types, positions or defense strategies need --grid.')
+    if args.run.grid:
+        os.makedirs(args.run.save_path, exist_ok=True)
+
+    summary = []
+    if args.run.batch_variants:
+        # All cells are reranked together: for every query the heapsorts of all cells run in lockstep and their
+        # comparisons share forward passes, so the wall time is shared and reported amortized over the cells.
+        if not args.setwise or args.run.openai_key:
+            raise ValueError('--batch_variants is only supported for local setwise models.')
+        variant_results = {cell: [] for cell in cells}
+        variant_stats = {cell: [0, 0, 0] for cell in cells}
+        tic = time.time()
+        for qid, query, ranking in tqdm(first_stage_rankings):
+            reranked = ranker.rerank_variants(query, ranking, cells)
+            for cell in cells:
+                variant_results[cell].append((qid, query, reranked[cell]))
+                variant_stats[cell][0] += ranker.variant_compare[cell]
+                variant_stats[cell][1] += ranker.variant_prompt_tokens[cell]
+                variant_stats[cell][2] += ranker.variant_completion_tokens[cell]
+        toc = time.time()
+
+        num_queries = len(first_stage_rankings)
+        for cell in cells:
+            attack_type, attack_position, defense_strategy = cell
+            if args.run.grid:
+                save_path = os.path.join(args.run.save_path, f'{attack_type}_{attack_position}_{defense_strategy}.txt')
+            else:
+                save_path = args.run.save_path
+            write_run_file(save_path, variant_results[cell], 'LLMRankers')
+            summary.append((attack_type, attack_position, defense_strategy,
+                            variant_stats[cell][0] / num_queries,
+                            variant_stats[cell][1] / num_queries,
+                            variant_stats[cell][2] / num_queries,
+                            (toc - tic) / num_queries / len(cells),
+                            mean_ndcg(variant_results[cell], qrels_map, k=10)))
+        cells = []
+
+    for attack_type, attack_position, defense_strategy in cells:
+        reranked_results = []
+        total_comparisons = 0
+        total_prompt_tokens = 0
+        total_completion_tokens = 0
+
+        tic = time.time()
+        for qid, query, ranking in tqdm(first_stage_rankings):
+            # heapSort reorders the given list in place, so every cell starts from a copy of the first stage order
+            reranked_results.append((qid, query, ranker.rerank(query, list(ranking), attack_prompt=attack_type, attack_position=attack_position, defense_strategy=defense_strategy)))
+            total_comparisons += ranker.total_compare
+            total_prompt_tokens += ranker.total_prompt_tokens
+            total_completion_tokens += ranker.total_completion_tokens
+        toc = time.time()
+
+        print(f'attack_type={attack_type} attack_position={attack_position} defense_strategy={defense_strategy}')
+        print(f'Avg comparisons: {total_comparisons/len(reranked_results)}')
+        print(f'Avg input token length: {total_prompt_tokens/total_comparisons}')
+        print(f'Avg prompt tokens: {total_prompt_tokens/len(reranked_results)}')
+        print(f'Avg completion tokens: {total_completion_tokens/len(reranked_results)}')
+        print(f'Avg time per query: {(toc-tic)/len(reranked_results)}')
+
+        if args.run.grid:
+            save_path = os.path.join(args.run.save_path, f'{attack_type}_{attack_position}_{defense_strategy}.txt')
+        else:
+            save_path = args.run.save_path
+        write_run_file(save_path, reranked_results, 'LLMRankers')
 
-    print(f'Avg comparisons: {total_comparisons/len(reranked_results)}')
-    print(f'Avg input token length: {total_prompt_tokens/total_comparisons}')
-    print(f'Avg prompt tokens: {total_prompt_tokens/len(reranked_results)}')
-    print(f'Avg completion tokens: {total_completion_tokens/len(reranked_results)}')
-    print(f'Avg time per query: {(toc-tic)/len(reranked_results)}')
+        summary.append((attack_type, attack_position, defense_strategy,
+                        total_comparisons / len(reranked_results),
+                        total_prompt_tokens / len(reranked_results),
+                        total_completion_tokens / len(reranked_results),
+                        (toc - tic) / len(reranked_results),
+                        mean_ndcg(reranked_results, qrels_map, k=10)))
 
-    write_run_file(args.run.save_path, reranked_results, 'LLMRankers')
+    if args.run.grid:
+        write_summary(os.path.join(args.run.save_path, 'summary.tsv'), summary)
 
 
 if __name__ == '__main__':
@@ -252,14 +336,21 @@ if __name__ == '__main__':
     run_parser.add_argument('--openai_key', type=str, default=None)
     run_parser.add_argument('--scoring', type=str, default='generation', choices=['generation', 'likelihood'])
     run_parser.add_argument('--shuffle_ranking', type=str, default=None, choices=['inverse', 'random'])
-    run_parser.add_argument("--attack_type", choices=["none", "so", "sd"], default="none",
-                        help="Attack type: none (disable), so, or sd.")
-    run_parser.add_argument("--attack_position", choices=["front", "back"], default="back",
-                        help="Position to place the attack prompt: 'front' or 'back' of the passage")
+    run_parser.add_argument("--attack_type", choices=["none", "so", "sd"], nargs='+', default=["none"],
+                        help="Attack type: none (disable), so, or sd. Several values need --grid.")
+    run_parser.add_argument("--attack_position", choices=["front", "back"], nargs='+', default=["back"],
+                        help="Position to place the attack prompt: 'front' or 'back' of the passage. Several values need --grid.")
     run_parser.add_argument("--defense_strategy", type=str,
                         choices=["none", "content_isolation", "instruction_reminder", "strict_format", "combined", "sandwich_shield"],
-                        default="none",
-                        help="Defense strategy to apply to prompts")
+                        nargs='+', default=["none"],
+                        help="Defense strategy to apply to prompts. Several values need --grid.")
+    run_parser.add_argument("--grid", action='store_true',
+                        help="Run every combination of the given attack types, positions and defense strategies with "
+                             "the model loaded once. --save_path is then a directory that gets one run file per "
+                             "combination and a summary.tsv.")
+    run_parser.add_argument("--batch_variants", action='store_true',
+                        help="With local setwise heapsort, rerank all combinations together so that their comparisons "
+                             "share batched forward passes (num_permutation 1 only).")
 
     pointwise_parser = commands.add_parser('pointwise')
     pointwise_parser.add_argument('--method', type=str, default='yes_no',